@@ -1,27 +1,79 @@
+import itertools
 import json
 import os
 import re
 import sys
+import threading
+import time
 
-import requests
 import sublime
 import sublime_plugin
 
-try:
-    import lxml.html
-    HTML_PRETTIFY = True
-except ImportError:
-    HTML_PRETTIFY = False
+# requests is imported when a command first needs it: most editor sessions
+# never run one, and Sublime loads every plugin at startup.
 
+_import_start = time.time()
 
 abspath = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(abspath)
 import markdown2
 
 
+def iter_json(data, chunk_size=65536):
+    """
+    Serialize `data` as json.dumps() does, yielding UTF-8 chunks of about
+    `chunk_size` bytes. Long strings, i.e. the page body, are escaped a slice
+    at a time, so no escaped copy of the whole body is built. See
+    ConfluenceApi._send_json() for how the chunks are sent.
+    """
+    buffer = []
+    size = 0
+    for piece in _iter_json_pieces(data, chunk_size):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def _iter_json_pieces(data, chunk_size):
+    if isinstance(data, dict):
+        yield "{"
+        for i, (key, value) in enumerate(data.items()):
+            if not isinstance(key, str):
+                # json.dumps() turns these keys into strings (bool is an int)
+                if key is not None and not isinstance(key, (int, float)):
+                    raise TypeError("keys must be str, int, float, bool or None, "
+                                    "not {}".format(type(key).__name__))
+                key = json.dumps(key)
+            yield "{}{}: ".format(i and ", " or "", json.dumps(key))
+            for piece in _iter_json_pieces(value, chunk_size):
+                yield piece
+        yield "}"
+    elif isinstance(data, (list, tuple)):
+        yield "["
+        for i, value in enumerate(data):
+            if i:
+                yield ", "
+            for piece in _iter_json_pieces(value, chunk_size):
+                yield piece
+        yield "]"
+    elif isinstance(data, str) and len(data) > chunk_size:
+        yield '"'
+        for start in range(0, len(data), chunk_size):
+            yield json.dumps(data[start:start + chunk_size])[1:-1]
+        yield '"'
+    else:
+        yield json.dumps(data)
+
+
 class ConfluenceApi(object):
 
     def __init__(self, username, password, base_uri):
+        import requests
         self.username = username
         self.password = password
         self.base_uri = base_uri
@@ -42,14 +94,33 @@ class ConfluenceApi(object):
             method, url, headers=headers, verify=False, **kwargs)
         return response
 
+    def _send_json(self, method, url, data):
+        """
+        Send `data` as the JSON request body. A body that fits in one iter_json()
+        chunk is sent as is; a longer one is streamed, with chunked transfer
+        encoding. If that is refused (411 Length Required, from a proxy say) or
+        redirected (307/308: requests would follow with the spent generator,
+        i.e. an empty body), the body is built in full and sent again.
+        """
+        chunks = iter_json(data)
+        first = next(chunks, b"")
+        second = next(chunks, None)
+        if second is None:
+            return self._request(method, url, data=first)
+        body = itertools.chain((first, second), chunks)
+        response = self._request(method, url, data=body, allow_redirects=False)
+        if response.status_code in (307, 308, 411):
+            response = self._request(method, url, data=b"".join(iter_json(data)))
+        return response
+
     def _post(self, url, data=None):
-        return self._request("post", url, data=json.dumps(data))
+        return self._send_json("post", url, data)
 
     def _get(self, url, params=None):
         return self._request("get", url, params=params)
 
     def _put(self, url, data=None):
-        return self._request("put", url, data=json.dumps(data))
+        return self._send_json("put", url, data)
 
     def _delete(self, url, params=None):
         return self._request("delete", url, params=params)
@@ -90,8 +161,104 @@ class ConfluenceApi(object):
         return self._delete("content/{}".format(content_id))
 
 
-class Markup(object):
+class ConfluenceMarkdown(markdown2.Markdown):
+    r"""
+    Markdown converter emitting fenced code blocks as Confluence "code" macros
+    (storage format) instead of Pygments-colored HTML. The code goes in as
+    typed, entities included:
+
+    >>> md = ConfluenceMarkdown(extras=["fenced-code-blocks"])
+    >>> print(md.convert("```\nif a < b and c &amp; d:\n    s = ']]>'\n```\n"))
+    <ac:structured-macro ac:name="code"><ac:plain-text-body><![CDATA[if a < b and c &amp; d:
+        s = ']]]]><![CDATA[>']]></ac:plain-text-body></ac:structured-macro>
+    <BLANKLINE>
+    """
+    # fence info string -> language name known by the Confluence code macro
+    languages = dict([
+        ("c", "cpp"), ("c++", "cpp"), ("cs", "csharp"), ("c#", "csharp"),
+        ("erl", "erlang"), ("html", "xml"), ("js", "javascript"),
+        ("py", "python"), ("rb", "ruby"), ("sh", "bash"), ("shell", "bash"),
+        ("ps1", "powershell"), ("vbnet", "vb")])
+
+    def _code_block_sub(self, match, is_fenced_code_block=False):
+        if not is_fenced_code_block:
+            return super(ConfluenceMarkdown, self)._code_block_sub(match)
+        # the CDATA section takes the code as written: no entities to decode
+        codeblock = self._unhash_html_spans(match.group(2)[:-1])
+        macro = self.code_macro(codeblock, match.group(1))
+        key = self._hash_text(macro)
+        self.html_blocks[key] = macro
+        return "\n\n" + key + "\n\n"
+
+    def code_macro(self, code, language=None):
+        parameters = ""
+        if language:
+            language = language.lower()
+            language = self.languages.get(language, language)
+            parameters = '<ac:parameter ac:name="language">{}</ac:parameter>'.format(language)
+        # "]]>" can't appear inside CDATA: close the section and reopen it
+        code = code.replace("]]>", "]]]]><![CDATA[>")
+        return ('<ac:structured-macro ac:name="code">{}'
+                '<ac:plain-text-body><![CDATA[{}]]></ac:plain-text-body>'
+                '</ac:structured-macro>').format(parameters, code)
+
+
+class RstPublisher(object):
+    """
+    Converts reStructuredText to a Confluence storage format body, reusing one
+    docutils publisher and its settings for every conversion.
+    """
+    settings_overrides = {
+        "input_encoding": "unicode",
+        "output_encoding": "unicode",
+        # keep a leading section title in the body: the page title is separate
+        "doctitle_xform": False,
+        # don't read docutils.conf files
+        "_disable_config": True,
+    }
+    _instance = None
+    _instance_lock = threading.Lock()
+
     def __init__(self):
+        from docutils.core import Publisher
+        from docutils.io import StringInput, StringOutput
+        self.publisher = Publisher(source_class=StringInput, destination_class=StringOutput)
+        self.publisher.set_components("standalone", "restructuredtext", "html4css1")
+        self.publisher.process_programmatic_settings(None, self.settings_overrides, None)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def warm_up(cls):
+        """
+        Import docutils and build the publisher ahead of the first conversion,
+        e.g. on Sublime's async thread. A missing docutils is reported when
+        converting.
+        """
+        try:
+            cls.get()
+        except ImportError:
+            pass
+
+    def convert(self, content):
+        with self.lock:
+            self.publisher.set_source(content)
+            self.publisher.set_destination()
+            self.publisher.publish()
+            return self.publisher.writer.parts["body"]
+
+
+class Markup(object):
+    def __init__(self, code_macros=False, deterministic=True):
+        self.code_macros = code_macros
+        # byte-stable output, so that an unchanged document renders the same
+        self.extras = deterministic and ["deterministic"] or []
         self.markups = dict([
             ("Markdown", self.markdown_to_html),
             ("Markdown Extended", self.markdown_to_html),
@@ -99,12 +266,16 @@ class Markup(object):
             ("reStructuredText", self.rst_to_html)])
 
     def markdown_to_html(self, content):
-        return markdown2.markdown(content).encode("utf-8").decode()
+        if self.code_macros:
+            extras = self.extras + ["fenced-code-blocks"]
+            html = ConfluenceMarkdown(extras=extras).convert(content)
+        else:
+            html = markdown2.markdown(content, extras=self.extras)
+        return html
 
     def rst_to_html(self, content):
         try:
-            from docutils.core import publish_string
-            return publish_string(content, writer_name="html")
+            return RstPublisher.get().convert(content)
         except ImportError:
             error_msg = """
             RstPreview requires docutils to be installed for the python interpreter that Sublime uses.
@@ -127,22 +298,308 @@ class Markup(object):
                 "Can not parse this document.")
         return new_content
 
+    # page metadata header keys (lower case, words separated by a space)
+    meta_keys = dict([
+        ("space", "space_key"), ("space key", "space_key"),
+        ("ancestor title", "ancestor_title"), ("parent title", "ancestor_title"),
+        ("ancestor id", "parent_id"), ("parent id", "parent_id"),
+        ("title", "title"), ("labels", "labels")])
+    # "---" and "key: value" lines, indented continuation lines or "- item"
+    # lines, then "---" or "..." (the first character tells the kinds of line
+    # apart, so a header that isn't closed fails without backtracking)
+    front_matter_open_re = re.compile(r"---[ \t]*(?:\r?\n|\Z)")
+    front_matter_re = re.compile(
+        r"---[ \t]*\r?\n"
+        r"((?:(?:[^ \t\r\n:-][^\r\n:]*:|[ \t]+\S|-[ \t])[^\r\n]*\r?\n)*)"
+        r"(?:---|\.\.\.)[ \t]*(?:\r?\n|\Z)")
+    blank_line_re = re.compile(r"^[ \t\r\f\v]*(?:\n|\Z)", re.M)
+
     def get_meta_and_content(self, contents):
+        r"""
+        Split the page metadata from the document: either "Key: value" lines up
+        to the first blank line, or "---" delimited front matter. Only the
+        header is scanned and parsed; the body is returned as one slice. A "---"
+        header that isn't closed is left in the body, with no metadata.
+
+        >>> Markup().get_meta_and_content("---\ntitle: T\n---\nbody\n")
+        ({'title': 'T'}, 'body\n')
+        >>> Markup().get_meta_and_content("---\ntitle: T\n\ntext\n---\n")
+        ({}, '---\ntitle: T\n\ntext\n---\n')
+        """
+        match = self.front_matter_re.match(contents)
+        if match:
+            return (self.parse_meta(match.group(1)), contents[match.end():])
+        if self.front_matter_open_re.match(contents):
+            return (dict(), contents)
+        match = self.blank_line_re.search(contents)
+        if not match:
+            return (self.parse_meta(contents), "")
+        return (self.parse_meta(contents[:match.start()]), contents[match.end():])
+
+    def parse_meta(self, header):
+        """
+        Parse "Key: value" lines, including the bits of YAML front matter that
+        are useful here: quoted values and labels given as "a, b", "[a, b]" or
+        as "- a" lines.
+        """
         meta = dict()
-        content = list()
-        tmp = contents.splitlines()
-        for x, entry in enumerate(tmp):
-            if entry.strip():
-                if re.match(r"[Ss]pace: *", entry):
-                    meta["space_key"] = re.sub("[^:]*: *", "", entry)
-                elif re.match(r"[Aa]ncestor Title: *", entry):
-                    meta["ancestor_title"] = re.sub("[^:]*: *", "", entry)
-                elif re.match(r"[Tt]itle: *", entry):
-                    meta["title"] = re.sub("[^:]*: *", "", entry)
+        name = None
+        for line in header.splitlines():
+            entry = line.strip()
+            if name == "labels" and entry.startswith("- "):
+                meta["labels"].append(self.unquote(entry[2:].strip()))
+                continue
+            key, sep, value = entry.partition(":")
+            key = " ".join(key.replace("_", " ").replace("-", " ").lower().split())
+            name = sep and self.meta_keys.get(key)
+            if not name:
+                continue
+            value = value.strip()
+            if name == "labels":
+                meta[name] = [self.unquote(label)
+                              for label in re.split(r"[\s,]+", value.strip("[]")) if label]
             else:
-                content = tmp[x + 1:]
-                break
-        return (meta, content)
+                meta[name] = self.unquote(value)
+        return meta
+
+    def unquote(self, value):
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+            return value[1:-1]
+        return value
+
+
+class StorageFormatter(object):
+    r"""
+    Pretty prints Confluence storage format (XHTML) in a single pass: block
+    level elements start a new line, indented by their depth. Text, inline
+    markup, <pre> and macro bodies are left exactly as they are, and so is any
+    whitespace that isn't next to a block level tag. Like lxml's pretty_print,
+    nothing is added in mixed content: a macro among text or inline markup
+    (a status lozenge in a paragraph, say) is left inline, as it is. To tell,
+    the rest of an element holding a macro is looked ahead at, once.
+
+    unformat() takes out what was added, so a page can go back as it came:
+
+    >>> formatter = StorageFormatter("  ")
+    >>> body = ('<p>See <ac:structured-macro ac:name="status"><ac:parameter '
+    ...         'ac:name="title">OK</ac:parameter></ac:structured-macro> now</p>'
+    ...         '<ac:structured-macro ac:name="code"><ac:plain-text-body>'
+    ...         '<![CDATA[if a:\n    b()]]></ac:plain-text-body></ac:structured-macro>')
+    >>> text = "".join(formatter.iter_chunks(body))
+    >>> print(text)
+    <p>See <ac:structured-macro ac:name="status"><ac:parameter ac:name="title">OK</ac:parameter></ac:structured-macro> now</p>
+    <ac:structured-macro ac:name="code">
+      <ac:plain-text-body><![CDATA[if a:
+        b()]]></ac:plain-text-body>
+    </ac:structured-macro>
+    <BLANKLINE>
+    >>> formatter.unformat(text) == body
+    True
+    """
+    # a tag, with the "/" of a closing tag and the element name as groups; or
+    # a CDATA section, a comment, text or a stray "<"
+    token_re = re.compile(
+        r"<!\[CDATA\[.*?\]\]>|<!--.*?-->|<(/?)([\w:.-]+)[^>]*>|[^<]+|<[^>]*>?", re.S)
+    block_tags = set([
+        "address", "blockquote", "dd", "div", "dl", "dt", "h1", "h2", "h3",
+        "h4", "h5", "h6", "hr", "li", "ol", "p", "pre", "table", "caption",
+        "colgroup", "col", "thead", "tbody", "tfoot", "tr", "th", "td", "ul",
+        "ac:structured-macro", "ac:parameter", "ac:rich-text-body",
+        "ac:plain-text-body", "ac:layout", "ac:layout-section",
+        "ac:layout-cell", "ac:task-list", "ac:task", "ac:task-id",
+        "ac:task-status", "ac:task-body"])
+    # block level tags that are inline in mixed content; at the top level of
+    # the body (where Confluence puts text in a <p>) they are blocks
+    macro_tags = set(["ac:structured-macro"])
+    void_tags = set(["br", "col", "hr", "img"])
+    # elements whose content is kept verbatim
+    verbatim_tags = set(["pre", "ac:plain-text-body"])
+    # whitespace that isn't significant next to a block level tag (unlike
+    # a non-breaking space)
+    spaces = " \t\r\n"
+
+    def __init__(self, indent="    "):
+        self.indent = indent
+
+    def iter_chunks(self, body, chunk_size=65536):
+        """Yield the pretty printed body in chunks of about `chunk_size`."""
+        buffer = []
+        size = 0
+        for piece in self._iter_pieces(body):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+        buffer.append("\n")
+        yield "".join(buffer)
+
+    def unformat(self, text):
+        """
+        Undo the pretty printing of iter_chunks(): drop the whitespace next to
+        block level tags where it has a line break. Text, inline macros and
+        verbatim elements are left as they are.
+        """
+        pieces = []
+        # the index in pieces of the text just before the current token
+        text_index = None
+        after_block = True
+        for match, kind in self._iter_tokens(text):
+            token = match.group()
+            if kind == "text":
+                stripped = token.lstrip(self.spaces)
+                if after_block and "\n" in token[:len(token) - len(stripped)]:
+                    token = stripped
+                text_index = len(pieces)
+            else:
+                if kind == "block" and text_index is not None:
+                    pieces[text_index] = self._rstrip_break(pieces[text_index])
+                text_index = None
+            pieces.append(token)
+            after_block = kind == "block"
+        if text_index is not None:
+            pieces[text_index] = self._rstrip_break(pieces[text_index])
+        return "".join(pieces)
+
+    def _rstrip_break(self, text):
+        stripped = text.rstrip(self.spaces)
+        if "\n" in text[len(stripped):]:
+            return stripped
+        return text
+
+    def _iter_pieces(self, body):
+        # for each open block element: whether it has a block level child
+        nested = []
+        # whitespace that is dropped if a block level tag comes next
+        space = ""
+        # whether the last thing written was a block level tag
+        after_block = False
+        first = True
+        for match, kind in self._iter_tokens(body):
+            token = match.group()
+            if kind == "verbatim":
+                yield token
+                continue
+            if kind == "text":
+                if after_block:
+                    token = token.lstrip(self.spaces)
+                text = token.rstrip(self.spaces)
+                if text:
+                    yield space + text
+                    space = token[len(text):]
+                    after_block = first = False
+                elif not after_block:
+                    space += token
+                continue
+            space = ""
+            if match.group(1):
+                if nested and nested.pop():
+                    yield "\n" + self.indent * len(nested)
+                yield token
+            else:
+                if nested:
+                    nested[-1] = True
+                if not first:
+                    yield "\n" + self.indent * len(nested)
+                yield token
+                if self._opens(match):
+                    nested.append(False)
+            after_block = True
+            first = False
+
+    def _opens(self, match):
+        """Whether the block level tag `match` opens an element with content."""
+        return not match.group().endswith("/>") and match.group(2).lower() not in self.void_tags
+
+    def _iter_tokens(self, body):
+        """
+        Yield (match, kind) for each token of `body`: kind is "block" for a block
+        level tag, "verbatim" for the content of a verbatim element or an inline
+        macro, and "text" for text, inline markup or the start of an inline macro.
+        """
+        # for each open block element: whether it has text or inline markup of
+        # its own so far, and whether it has any at all (None until needed)
+        mixed = []
+        verbatim = None
+        # the name of the inline macro being copied, and its depth
+        inline = None
+        depth = 0
+        for match in self.token_re.finditer(body):
+            name = match.group(2)
+            if name:
+                name = name.lower()
+            if inline:
+                if name == inline:
+                    depth += match.group(1) and -1 or self._opens(match)
+                    if not depth:
+                        inline = None
+                yield match, "verbatim"
+                continue
+            if verbatim:
+                if name == verbatim and match.group(1):
+                    verbatim = None
+                    mixed.pop()
+                    yield match, "block"
+                else:
+                    yield match, "verbatim"
+                continue
+            if name in self.macro_tags and not match.group(1) and mixed:
+                if not mixed[-1][0] and mixed[-1][1] is None:
+                    mixed[-1][1] = self._has_text(body, match.start())
+                if mixed[-1][0] or mixed[-1][1]:
+                    if self._opens(match):
+                        inline = name
+                        depth = 1
+                    name = None
+            if name not in self.block_tags:
+                if mixed and self._is_content(match.group()):
+                    mixed[-1][0] = True
+                yield match, "text"
+                continue
+            if match.group(1):
+                if mixed:
+                    mixed.pop()
+            elif self._opens(match):
+                mixed.append([False, None])
+                if name in self.verbatim_tags:
+                    verbatim = name
+            yield match, "block"
+
+    def _is_content(self, token):
+        """
+        Whether `token` makes the element it is in mixed content: text, even a
+        space (but not a line break and indentation), or inline markup.
+        """
+        return not token.startswith("<!--") and ("\n" not in token or token.strip(self.spaces))
+
+    def _has_text(self, body, pos):
+        """
+        Whether the block level element open at `pos` in `body` has text or
+        inline markup of its own from there on.
+        """
+        depth = 0
+        verbatim = None
+        for match in self.token_re.finditer(body, pos):
+            name = match.group(2)
+            if name:
+                name = name.lower()
+            if verbatim:
+                if name == verbatim and match.group(1):
+                    verbatim = None
+                    depth -= 1
+            elif name not in self.block_tags:
+                if not depth and self._is_content(match.group()):
+                    return True
+            elif match.group(1):
+                if not depth:
+                    return False
+                depth -= 1
+            elif self._opens(match):
+                depth += 1
+                if name in self.verbatim_tags:
+                    verbatim = name
+        return False
 
 
 class BaseConfluencePageCommand(sublime_plugin.TextCommand):
@@ -161,6 +618,22 @@ class BaseConfluencePageCommand(sublime_plugin.TextCommand):
         self.username = settings.get("username")
         self.password = settings.get("password") if settings.get("password") else ""
         self.default_space_key = settings.get("default_space_key")
+        self.code_macros = settings.get("code_macros", True)
+        if "reStructuredText" in (self.view.settings().get("syntax") or ""):
+            # load docutils while the credentials are being entered
+            sublime.set_timeout_async(RstPublisher.warm_up, 0)
+
+    def render(self):
+        """
+        Return the page metadata and the rendered body of the view. The view
+        text is dropped as soon as the body is sliced out of it, so it isn't
+        held while rendering or sending.
+        """
+        contents = self.view.substr(sublime.Region(0, self.view.size()))
+        markup = Markup(code_macros=self.code_macros)
+        meta, content = markup.get_meta_and_content(contents)
+        del contents
+        return (meta, markup.to_html(content, self.view.settings().get("syntax")))
 
     def get_credential(self):
         if not self.username and not self.password:
@@ -247,37 +720,44 @@ class PostConfluencePageCommand(BaseConfluencePageCommand):
         sublime.set_timeout(self.get_credential, 50)
 
     def post(self):
-        region = sublime.Region(0, self.view.size())
-        contents = self.view.substr(region)
-        markup = Markup()
-        meta, content = markup.get_meta_and_content(contents)
-        syntax = self.view.settings().get("syntax")
-        new_content = markup.to_html("\n".join(content), syntax)
+        meta, new_content = self.render()
         if not new_content:
             return
+        ancestor_id = None
+        if "parent_id" in meta:
+            try:
+                ancestor_id = int(meta["parent_id"])
+            except (TypeError, ValueError):
+                sublime.error_message(
+                    "Parent Id must be a page id, got: {}".format(meta["parent_id"]))
+                return
         self.confluence_api = ConfluenceApi(self.username, self.password, self.base_uri)
-        response = self.confluence_api.get_content_by_title(
-            meta["space_key"], meta["ancestor_title"])
-        if response.ok:
+        if ancestor_id is None:
+            response = self.confluence_api.get_content_by_title(
+                meta["space_key"], meta["ancestor_title"])
+            if not response.ok:
+                print(response.text)
+                sublime.error_message("Can not get ancestor, reason: {}".format(response.reason))
+                return
             ancestor = response.json()["results"][0]
             ancestor_id = int(ancestor["id"])
-            space = dict(key=meta["space_key"])
-            body = dict(storage=dict(value=new_content, representation="storage"))
-            data = dict(type="page", title=meta["title"], ancestors=[dict(id=ancestor_id)],
-                        space=space, body=body)
-            result = self.confluence_api.create_content(data)
-            if result.ok:
-                self.view.settings().set("confluence_content", result.json())
-                # copy content url
-                content_uri = self.confluence_api.get_content_uri(result.json())
-                sublime.set_clipboard(content_uri)
-                sublime.status_message(self.MSG_SUCCESS)
-            else:
-                print(result.text)
-                sublime.error_message("Can not create content, reason: {}".format(result.reason))
+        space = dict(key=meta["space_key"])
+        body = dict(storage=dict(value=new_content, representation="storage"))
+        data = dict(type="page", title=meta["title"], ancestors=[dict(id=ancestor_id)],
+                    space=space, body=body)
+        if meta.get("labels"):
+            labels = [dict(prefix="global", name=label) for label in meta["labels"]]
+            data["metadata"] = dict(labels=labels)
+        result = self.confluence_api.create_content(data)
+        if result.ok:
+            self.view.settings().set("confluence_content", result.json())
+            # copy content url
+            content_uri = self.confluence_api.get_content_uri(result.json())
+            sublime.set_clipboard(content_uri)
+            sublime.status_message(self.MSG_SUCCESS)
         else:
-            print(response.text)
-            sublime.error_message("Can not get ancestor, reason: {}".format(response.reason))
+            print(result.text)
+            sublime.error_message("Can not create content, reason: {}".format(result.reason))
 
 
 class GetConfluencePageCommand(BaseConfluencePageCommand):
@@ -344,31 +824,41 @@ class GetConfluencePageCommand(BaseConfluencePageCommand):
         if response.ok:
             content = response.json()
             body = content["body"]["storage"]["value"]
-            if HTML_PRETTIFY:
-                document_root = lxml.html.fromstring(body)
-                body = (lxml.etree.tostring(document_root, encoding="unicode", pretty_print=True))
 
             new_view = self.view.window().new_file()
             # set syntax file
             new_view.set_syntax_file("Packages/HTML/HTML.sublime-syntax")
-            new_view.settings().set("auto_indent", False)
-
-            # insert the page
-            new_view.run_command("insert", {"characters": body})
             new_view.set_name(content["title"])
-            new_view.settings().set("confluence_content", content)
-            new_view.settings().set("auto_indent", True)
-            new_view.run_command("reindent", {"single_line": False})
-            new_view.run_command("expand_tabs", {"set_translate_tabs": True})
-
-            # copy content url
-            content_uri = self.confluence_api.get_content_uri(content)
-            sublime.set_clipboard(content_uri)
-            sublime.status_message(self.MSG_SUCCESS)
+            # read only until the whole page is in, so a partial page can't be
+            # edited or pushed back
+            new_view.set_read_only(True)
+            indent = " " * new_view.settings().get("tab_size", 4)
+            chunks = StorageFormatter(indent).iter_chunks(body)
+            self.insert_chunks(new_view, chunks, content)
         else:
             print(response.text)
             sublime.error_message("Can not get content, reason: {}".format(response.reason))
 
+    def insert_chunks(self, view, chunks, content):
+        """
+        Insert the next chunk of the page, then let Sublime draw and handle
+        input before inserting the one after, so a big page is readable while
+        it is still loading.
+        """
+        chunk = next(chunks, None)
+        if chunk is not None:
+            view.run_command("append", {"characters": chunk, "force": True,
+                                        "scroll_to_end": False})
+            sublime.set_timeout(lambda: self.insert_chunks(view, chunks, content), 0)
+            return
+        view.set_read_only(False)
+        view.settings().set("confluence_content", content)
+
+        # copy content url
+        content_uri = self.confluence_api.get_content_uri(content)
+        sublime.set_clipboard(content_uri)
+        sublime.status_message(self.MSG_SUCCESS)
+
 
 class UpdateConfluencePageCommand(BaseConfluencePageCommand):
     MSG_SUCCESS = "Page updated and url copied to the clipboard."
@@ -407,15 +897,12 @@ class UpdateConfluencePageCommand(BaseConfluencePageCommand):
         title = self.content["title"]
         space_key = self.content["space"]["key"]
         version_number = self.content["version"]["number"] + 1
-        region = sublime.Region(0, self.view.size())
-        contents = self.view.substr(region)
         syntax = self.view.settings().get("syntax")
         if "HTML" in syntax:
-            new_content = "".join(contents.split("\n"))
+            region = sublime.Region(0, self.view.size())
+            new_content = StorageFormatter().unformat(self.view.substr(region))
         else:
-            markup = Markup()
-            meta, content = markup.get_meta_and_content(contents)
-            new_content = markup.to_html("\n".join(content), syntax)
+            meta, new_content = self.render()
 
         space = dict(key=space_key)
         version = dict(number=version_number, minorEdit=False)
@@ -438,12 +925,7 @@ class UpdateConfluencePageCommand(BaseConfluencePageCommand):
             sublime.error_message("Can't update content, reason: {}".format(response.reason))
 
     def update_from_source(self):
-        region = sublime.Region(0, self.view.size())
-        contents = self.view.substr(region)
-        markup = Markup()
-        meta, content = markup.get_meta_and_content(contents)
-        syntax = self.view.settings().get("syntax")
-        new_content = markup.to_html("\n".join(content), syntax)
+        meta, new_content = self.render()
         if not new_content:
             sublime.error_message(
                 "Can't update: this doesn't appear to be a valid Confluence page.")
@@ -512,3 +994,82 @@ class DeleteConfluencePageCommand(BaseConfluencePageCommand):
         except Exception:
             print(response.text)
             sublime.error_message("Can't delete content, reason: {}".format(response.reason))
+
+
+IMPORT_TIME = time.time() - _import_start
+
+
+def _self_test():
+    """Run the doctests in this module, returning the number of failures."""
+    import doctest
+    return doctest.testmod(sys.modules[__name__]).failed
+
+
+def _benchmark_memory(size=3 * 1024 * 1024):
+    """
+    Print the peak memory traced while a Markdown page of about `size`
+    characters is rendered and serialized as a request body, as post() does
+    it and as it was done with full copies (an encode/decode round trip of
+    the HTML and a json.dumps() of the payload). Run it from the console
+    with: sublime.run_command("confluence_benchmark_memory")
+    """
+    import tracemalloc
+    block = ("## Section {}\n\nSome *text* with `code`, a [link](http://example.com)"
+             " and non-ASCII: caf\u00e9 \u2013 \u65e5\u672c.\n\n* one\n* two\n\n")
+    blocks = []
+    length = 0
+    while length < size:
+        blocks.append(block.format(len(blocks)))
+        length += len(blocks[-1])
+    contents = "Space: TST\nTitle: Benchmark\nAncestor Title: Home\n\n" + "".join(blocks)
+    del blocks
+
+    # each returns the HTML and whatever else post() used to keep while
+    # the payload was built and sent
+    def render_copying(contents):
+        lines = contents.splitlines()
+        content = "\n".join(lines[4:])
+        html = Markup().to_html(content, "Markdown").encode("utf-8").decode()
+        return html, (lines, content)
+
+    def render_streaming(contents):
+        markup = Markup()
+        meta, content = markup.get_meta_and_content(contents)
+        return markup.to_html(content, "Markdown"), None
+
+    def send_copying(data):
+        return len(json.dumps(data).encode("utf-8"))
+
+    def send_streaming(data):
+        return sum(len(chunk) for chunk in iter_json(data))
+
+    def traced(function, *args):
+        tracemalloc.start()
+        try:
+            result = function(*args)
+            return result, tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    print("Confluence: {:.1f} MB page".format(len(contents.encode("utf-8")) / 1e6))
+    print("  {:<10} {:>11} {:>9} {:>9}".format("", "render peak", "held", "send peak"))
+    for name, render, send in (("copying", render_copying, send_copying),
+                               ("streaming", render_streaming, send_streaming)):
+        (html, held), (size, render_peak) = traced(render, contents)
+        data = dict(type="page", body=dict(storage=dict(value=html, representation="storage")))
+        send_peak = traced(send, data)[1][1]
+        del html, held, data
+        print("  {:<10} {:8.1f} MB {:6.1f} MB {:6.1f} MB".format(
+            name, render_peak / 1e6, size / 1e6, send_peak / 1e6))
+
+
+class ConfluenceBenchmarkMemoryCommand(sublime_plugin.ApplicationCommand):
+    def run(self):
+        _benchmark_memory()
+
+
+def plugin_loaded():
+    settings = sublime.load_settings("Confluence.sublime-settings")
+    if settings.get("debug"):
+        print("Confluence: imported in {:.1f} ms".format(IMPORT_TIME * 1000))
+        print("Confluence: self-test, {} failures".format(_self_test()))
@@ -44,6 +44,9 @@ see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
 
 * code-friendly: Disable _ and __ for em and strong.
 * cuddled-lists: Allow lists to be cuddled to the preceding paragraph.
+* deterministic: Give byte-identical output for identical input and
+  options. The hashed placeholders are salted from the text instead of at
+  random, and each email address is always obfuscated the same way.
 * fenced-code-blocks: Allows a code block to not have to be indented
   by fencing it with '```' on a line before and after. Based on
   <http://github.github.com/github-flavored-markdown/> with support for
@@ -64,6 +67,11 @@ see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
   See <https://github.com/trentm/python-markdown2/issues/77> for details.
 * nofollow: Add `rel="nofollow"` to add `<a>` tags with an href. See
   <http://en.wikipedia.org/wiki/Nofollow>.
+* profile: Record wall time, call counts and (with tracemalloc) peak
+  memory for each conversion stage, and the hit rates of the Pygments
+  caches. The returned HTML string gets "profile" and "cache_stats"
+  attributes with the numbers and a "profile_report" attribute that
+  formats them as a table.
 * pyshell: Treats unindented Python interactive shell sessions as <code>
   blocks.
 * link-patterns: Auto-link given regex patterns in text (e.g. bug number
@@ -92,15 +100,19 @@ __version_info__ = (2, 3, 1)
 __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Trent Mick"
 
+import os
 import sys
 import re
+import copy
+import threading
 import logging
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 import optparse
-from random import random, randint
+from bisect import bisect_left
+from random import Random, random
 import codecs
 
 
@@ -123,6 +135,7 @@ elif sys.version_info[0] >= 3:
     py3 = True
     unicode = str
     base_string_type = str
+    unichr = chr
 
 
 
@@ -134,13 +147,43 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = bytes(randint(0, 1000000))
-def _hash_text(s):
-    return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
+# Salt for the hashed placeholders, so that the text being converted
+# can't forge one. It is hashed for every placeholder, so keep it short.
+SECRET_SALT = os.urandom(16)
+def _hash_text(s, salt=SECRET_SALT):
+    return 'md5-' + md5(salt + s.encode("utf-8")).hexdigest()
 
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Table of hash values for escaped characters, built by
+# `_get_escape_table()` when the first Markdown instance is created.
+g_escape_table = None
+
+def _get_escape_table():
+    global g_escape_table
+    if g_escape_table is None:
+        g_escape_table = dict([(ch, _hash_text(ch))
+            for ch in '\\`*_{}[]()>#+-.!'])
+    return g_escape_table
+
+class _lazy_re(object):
+    """Like `re.compile()`, but the regex is only compiled on first use.
+
+    Used for the many class and module level patterns, so that importing
+    this module (which Sublime does for every plugin at startup) doesn't
+    compile them all. Each attribute of the regex is looked up once and
+    then cached on this object, so using it costs no more than the regex.
+    """
+    def __init__(self, pattern, flags=0):
+        self._args = (pattern, flags)
+    def __getattr__(self, name):
+        if name.startswith('__') or name == '_args':
+            raise AttributeError(name)
+        value = getattr(re.compile(*self._args), name)
+        setattr(self, name, value)
+        return value
+
+# Matches any value produced by `_hash_text`, so that all hashed
+# placeholders can be restored in a single scan of the text.
+_hash_text_re = _lazy_re(r'md5-[0-9a-f]{32}')
 
 
 
@@ -165,6 +208,37 @@ def markdown_path(path, encoding="utf-8",
                     link_patterns=link_patterns,
                     use_file_vars=use_file_vars).convert(text)
 
+def markdown_stream(lines, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                    safe_mode=None, extras=None, link_patterns=None,
+                    use_file_vars=False):
+    """Convert Markdown from a file object or an iterable of lines,
+    yielding HTML chunks. See `Markdown.convert_stream()`.
+    """
+    return Markdown(html4tags=html4tags, tab_width=tab_width,
+                    safe_mode=safe_mode, extras=extras,
+                    link_patterns=link_patterns,
+                    use_file_vars=use_file_vars).convert_stream(lines)
+
+def markdown_paths(paths, encoding="utf-8",
+                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                   safe_mode=None, extras=None, link_patterns=None,
+                   use_file_vars=False, processes=1):
+    """Convert the Markdown files at `paths`, returning a list of their
+    HTML in order. See `Markdown.convert_many()`.
+    """
+    def texts():
+        for path in paths:
+            fp = codecs.open(path, 'r', encoding)
+            try:
+                yield fp.read()
+            finally:
+                fp.close()
+    return Markdown(html4tags=html4tags, tab_width=tab_width,
+                    safe_mode=safe_mode, extras=extras,
+                    link_patterns=link_patterns,
+                    use_file_vars=use_file_vars).convert_many(texts(),
+                                                              processes)
+
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
@@ -192,7 +266,7 @@ class Markdown(object):
     # (see _ProcessListItems() for details):
     list_level = 0
 
-    _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _ws_only_line_re = _lazy_re(r"^[ \t]+$", re.M)
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
                  extras=None, link_patterns=None, use_file_vars=False):
@@ -228,10 +302,43 @@ class Markdown(object):
         self.use_file_vars = use_file_vars
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
-        self._escape_table = g_escape_table.copy()
+        self._escape_table = _get_escape_table().copy()
         if "smarty-pants" in self.extras:
             self._escape_table['"'] = _hash_text('"')
             self._escape_table["'"] = _hash_text("'")
+        # Lookup tables for the single-pass escape/unescape engine: one
+        # regex scan over the text, with each hit resolved by a dict lookup.
+        self._backslash_escape_re = re.compile(r'\\[%s]'
+            % re.escape(''.join(self._escape_table)))
+        self._build_escape_lookups()
+
+    # The salt for the hashed placeholders of a conversion. The
+    # "deterministic" extra replaces it with one derived from the text.
+    _salt = SECRET_SALT
+
+    def _hash_text(self, s):
+        return _hash_text(s, self._salt)
+
+    def _build_escape_lookups(self):
+        self._escape_from_backslashed = dict([('\\' + ch, escape)
+            for ch, escape in self._escape_table.items()])
+        self._char_from_escape = dict([(escape, ch)
+            for ch, escape in self._escape_table.items()])
+
+    def _use_text_salt(self, lines):
+        """Derive the placeholder salt from the text being converted, so
+        that identical input gives byte-identical output.
+
+        The input would have to contain the hash of itself to forge a
+        placeholder, so this is as safe as a random salt.
+        """
+        digest = md5()
+        for line in _iter_stream_lines(lines):
+            digest.update(line.encode("utf-8"))
+        self._salt = digest.digest()
+        self._escape_table = dict([(ch, self._hash_text(ch))
+                                   for ch in self._escape_table])
+        self._build_escape_lookups()
 
     def reset(self):
         self.urls = {}
@@ -239,6 +346,8 @@ class Markdown(object):
         self.html_blocks = {}
         self.html_spans = {}
         self.list_level = 0
+        self._code_table = {}
+        self._toc = None
         self.extras = self._instance_extras.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
@@ -250,10 +359,26 @@ class Markdown(object):
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
-    _a_nofollow = re.compile(r"<(a)([^>]*href=)", re.IGNORECASE)
+    _a_nofollow = _lazy_re(r"<(a)([^>]*href=)", re.IGNORECASE)
 
     def convert(self, text):
-        """Convert the given text."""
+        """Convert the given text.
+
+        The state of a conversion (link definitions, hashed HTML,
+        footnotes, ...) is kept on a copy of this instance made for the
+        call, so a single configured Markdown instance can be shared by
+        several threads.
+        """
+        return self._context()._convert(text)
+
+    def _context(self):
+        """Return a copy of this instance to hold the state of a single
+        conversion. It shares the configuration (extras, link patterns,
+        escape tables); `reset()` gives it its own state.
+        """
+        return copy.copy(self)
+
+    def _convert(self, text):
         # Main function. The order in which other subs are called here is
         # essential. Link and image substitutions need to happen before
         # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
@@ -270,21 +395,227 @@ class Markdown(object):
             text = unicode(text, 'utf-8')
 
         if self.use_file_vars:
-            # Look for emacs-style file variable hints.
-            emacs_vars = self._get_emacs_vars(text)
-            if "markdown-extras" in emacs_vars:
-                splitter = re.compile("[ ,]+")
-                for e in splitter.split(emacs_vars["markdown-extras"]):
-                    if '=' in e:
-                        ename, earg = e.split('=', 1)
-                        try:
-                            earg = int(earg)
-                        except ValueError:
-                            pass
-                    else:
-                        ename, earg = e, None
-                    self.extras[ename] = earg
+            self._apply_emacs_vars(text)
+
+        if "deterministic" in self.extras:
+            self._use_text_salt([text])
+
+        if "profile" in self.extras:
+            profile = _StageProfile(self)
+            profile.start()
+
+        text = self._normalize_text(text)
+
+        # strip metadata from head and extract
+        if "metadata" in self.extras:
+            text = self._extract_metadata(text)
+
+        text = self.preprocess(text)
+
+        text = self._hash_raw_html(text)
+
+        text = self._strip_definitions(text)
+
+        text = self._run_block_gamut(text)
+
+        if "footnotes" in self.extras:
+            text = self._add_footnotes(text)
+
+        text = self._finish_html(text)
+
+        text += "\n"
+
+        rv = UnicodeWithAttrs(text)
+        if "toc" in self.extras:
+            rv._toc = self._toc
+        if "metadata" in self.extras:
+            rv.metadata = self.metadata
+        if "profile" in self.extras:
+            rv.profile = profile.stop()
+            rv.cache_stats = profile.cache_stats()
+        return rv
+
+    def convert_many(self, texts, processes=1):
+        """Convert each of the given texts, returning a list of the results
+        in order.
+
+        This instance, with its extras and compiled escape tables, is
+        reused for every document. Each result has a `stats` attribute:
+        a dict with the conversion time in "seconds" and the
+        "input_length" and "output_length" of the document.
+
+        With `processes` other than 1 the documents are converted in a
+        pool of that many worker processes (None for one per CPU). With
+        the "spawn" start method (the default on Windows and macOS) this
+        Markdown instance, including any `link_patterns`, must be
+        picklable.
+        """
+        if processes == 1:
+            return [self._convert_with_stats(text) for text in texts]
+
+        import multiprocessing
+
+        pool = multiprocessing.Pool(processes, _init_parallel_worker,
+                                    (self, None))
+        try:
+            return list(pool.imap(_convert_parallel_text, texts))
+        finally:
+            pool.terminate()
+
+    def _convert_with_stats(self, text):
+        from timeit import default_timer
+        start = default_timer()
+        rv = self.convert(text)
+        rv.stats = {"seconds": default_timer() - start,
+                    "input_length": len(text), "output_length": len(rv)}
+        return rv
+
+    def convert_stream(self, lines):
+        """Convert Markdown read from a file object or an iterable of lines,
+        yielding the HTML a top-level block at a time.
+
+        The input is read twice: a cheap first pass collects the link and
+        footnote definitions, the second renders. A seekable file or a
+        list is re-read in place; any other iterator is spooled to a
+        temporary file. Memory use is proportional to the largest run of
+        blocks that can't be split (a list, a block quote, a fenced code
+        block, an HTML block, or in safe mode the blocks an HTML span
+        runs across), not to the document.
+
+        Joining the chunks gives the same HTML as `convert()`, except that
+        `preprocess()` and `postprocess()` see one chunk at a time. The
+        "toc" and "metadata" results are left on this instance once all
+        the chunks have been read.
+        """
+        context = self._context()
+        for html in context._convert_stream(lines):
+            yield html
+        self._toc = context._toc
+        if "metadata" in context.extras:
+            self.metadata = context.metadata
+
+    def _convert_stream(self, lines):
+        self.reset()
+        open_lines, spool = self._rewindable_lines(lines)
+        try:
+            if self.use_file_vars:
+                self._apply_emacs_vars(_head_and_tail(open_lines()))
+            if "deterministic" in self.extras:
+                self._use_text_salt(open_lines())
+            closers, kept = self._prescan_stream(open_lines)
+            self._comment_scans = {}
+
+            emitted = False
+            chunks = self._iter_stream_chunks(open_lines(), closers)
+            for i, chunk in enumerate(chunks):
+                html = self._render_stream_chunk(chunk, i == 0, kept)
+                if html is not None:
+                    yield emitted and "\n\n" + html or html
+                    emitted = True
+            if not emitted:
+                # Match convert() on an empty document.
+                yield self._finish_html(self._run_block_gamut(""))
+            if "footnotes" in self.extras:
+                footer = self._add_footnotes("")
+                if footer:
+                    yield self._finish_html(footer)
+            yield "\n"
+        finally:
+            if spool is not None:
+                spool.close()
+
+    def convert_parallel(self, text, processes=None, batch_size=65536):
+        """Convert the given text, rendering its top-level blocks in a
+        pool of `processes` worker processes (by default one per CPU).
+
+        The text is split into chunks as for `convert_stream()`, and the
+        result is the same as joining that method's output. Chunks are
+        sent to the workers in batches of about `batch_size` characters.
+        Header ids and footnote numbers depend on the chunks before them,
+        so workers leave placeholders for them that are filled in, in
+        document order, as the results are stitched together. (This uses
+        the default de-duplication of header ids, even if a subclass
+        overrides `header_id_from_text()`.)
+
+        With the "spawn" start method (the default on Windows and macOS)
+        this Markdown instance, including any `link_patterns`, must be
+        picklable.
+        """
+        return self._context()._convert_parallel(text, processes, batch_size)
+
+    def _convert_parallel(self, text, processes, batch_size):
+        import multiprocessing
+
+        self.reset()
+
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8')
+
+        if self.use_file_vars:
+            self._apply_emacs_vars(text)
+
+        lines = list(_iter_stream_lines([text]))
+        open_lines = lambda: iter(lines)
+        if "deterministic" in self.extras:
+            self._use_text_salt(lines)
+        closers, kept = self._prescan_stream(open_lines)
+        chunks = self._iter_stream_chunks(open_lines(), closers)
+
+        parts = []
+        comment_scans = {}
+        pool = multiprocessing.Pool(processes, _init_parallel_worker,
+                                    (self, kept))
+        try:
+            for results in pool.imap(_render_parallel_batch,
+                                     _batch_chunks(chunks, batch_size)):
+                for result in results:
+                    redo = result[-1]
+                    if redo is not None and comment_scans:
+                        result = self._context()._render_parallel_chunk(
+                            redo, False, kept, comment_scans)
+                    html, footnote_ids, deferred, toc, scans, redo = result
+                    comment_scans.update(scans)
+                    html = self._stitch_parallel_chunk(html, footnote_ids,
+                                                       deferred, toc)
+                    if html is not None:
+                        parts.append(html)
+        finally:
+            pool.terminate()
+        if parts:
+            text = "\n\n".join(parts)
+        else:
+            # Match convert() on an empty document.
+            text = self._finish_html(self._run_block_gamut(""))
+
+        if "footnotes" in self.extras:
+            text += self._finish_html(self._add_footnotes(""))
+
+        text += "\n"
+
+        rv = UnicodeWithAttrs(text)
+        if "toc" in self.extras:
+            rv._toc = self._toc
+        if "metadata" in self.extras:
+            rv.metadata = self.metadata
+        return rv
 
+    def _apply_emacs_vars(self, text):
+        # Look for emacs-style file variable hints.
+        emacs_vars = self._get_emacs_vars(text)
+        if "markdown-extras" in emacs_vars:
+            splitter = re.compile("[ ,]+")
+            for e in splitter.split(emacs_vars["markdown-extras"]):
+                if '=' in e:
+                    ename, earg = e.split('=', 1)
+                    try:
+                        earg = int(earg)
+                    except ValueError:
+                        pass
+                else:
+                    ename, earg = e, None
+                self.extras[ename] = earg
+
+    def _normalize_text(self, text):
         # Standardize line endings:
         text = re.sub("\r\n|\r", "\n", text)
 
@@ -298,14 +629,9 @@ class Markdown(object):
         # This makes subsequent regexen easier to write, because we can
         # match consecutive blank lines with /\n+/ instead of something
         # contorted like /[ \t]*\n+/ .
-        text = self._ws_only_line_re.sub("", text)
-
-        # strip metadata from head and extract
-        if "metadata" in self.extras:
-            text = self._extract_metadata(text)
-
-        text = self.preprocess(text)
+        return self._ws_only_line_re.sub("", text)
 
+    def _hash_raw_html(self, text):
         if "fenced-code-blocks" in self.extras and not self.safe_mode:
             text = self._do_fenced_code_blocks(text)
 
@@ -317,20 +643,18 @@ class Markdown(object):
 
         if "fenced-code-blocks" in self.extras and self.safe_mode:
             text = self._do_fenced_code_blocks(text)
+        return text
 
+    def _strip_definitions(self, text):
         # Strip link definitions, store in hashes.
         if "footnotes" in self.extras:
             # Must do footnotes first because an unlucky footnote defn
             # looks like a link defn:
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
-        text = self._strip_link_definitions(text)
-
-        text = self._run_block_gamut(text)
-
-        if "footnotes" in self.extras:
-            text = self._add_footnotes(text)
+        return self._strip_link_definitions(text)
 
+    def _finish_html(self, text):
         text = self.postprocess(text)
 
         text = self._unescape_special_chars(text)
@@ -340,15 +664,329 @@ class Markdown(object):
 
         if "nofollow" in self.extras:
             text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        return text
 
-        text += "\n"
+    def _prepare_stream_chunk(self, chunk, is_first):
+        text = self._normalize_text(chunk)
+        if is_first and "metadata" in self.extras:
+            text = self._extract_metadata(text)
+        text = self.preprocess(text)
+        text = self._hash_raw_html(text)
+        return self._strip_definitions(text)
 
-        rv = UnicodeWithAttrs(text)
-        if "toc" in self.extras:
-            rv._toc = self._toc
-        if "metadata" in self.extras:
-            rv.metadata = self.metadata
-        return rv
+    def _prescan_stream(self, open_lines):
+        """Collect the link and footnote definitions from the whole of the
+        text, ahead of rendering it chunk by chunk.
+
+        Returns the `closers` for _iter_stream_chunks() and the hash table
+        entries to keep for every chunk (see _restore_hashes()).
+        """
+        # Footnote bodies are rendered at the very end and may refer to
+        # hashed HTML from their own chunk, so keep those hashes around.
+        #
+        # In safe mode a sanitized HTML span hashes to the same key as an
+        # identical sanitized HTML block, which makes a paragraph of just
+        # that span pass for the block *anywhere* in the document (see
+        # _form_paragraphs()). Keep those few keys as well.
+        closers = self._survey_stream_html(open_lines())
+        kept = ({}, {}, {})
+        span_text, block_keys = {}, set()
+        chunks = self._iter_stream_chunks(open_lines(), closers)
+        for i, chunk in enumerate(chunks):
+            if (i > 0 and ']:' not in chunk
+                    and not (self.safe_mode and '<' in chunk)):
+                continue
+            footnote_ids = set(getattr(self, 'footnotes', None) or ())
+            self._prepare_stream_chunk(chunk, i == 0)
+            if "footnotes" in self.extras:
+                for id in set(self.footnotes) - footnote_ids:
+                    self._keep_hashes(self.footnotes[id], kept)
+            if self.safe_mode:
+                span_text.update(self.html_spans)
+                block_keys.update(self.html_blocks)
+            self._restore_hashes(kept)
+        for key in block_keys:
+            if key in span_text:
+                kept[0][key] = span_text[key]
+        self._restore_hashes(kept)
+        return closers, kept
+
+    def _render_stream_chunk(self, chunk, is_first, kept):
+        """Render a chunk from _iter_stream_chunks(), or return None if
+        there is nothing left of it once definitions are stripped.
+        """
+        # The definitions were all collected by _prescan_stream().
+        urls, titles = self.urls, self.titles
+        footnotes = getattr(self, 'footnotes', None)
+        self.urls, self.titles, self.footnotes = {}, {}, {}
+        text = self._prepare_stream_chunk(chunk, is_first)
+        self.urls, self.titles, self.footnotes = urls, titles, footnotes
+        if text.strip('\n'):
+            text = self._run_block_gamut(text, top_level=True)
+            html = self._finish_html(text)
+        else:
+            html = None
+        self._restore_hashes(kept)
+        return html
+
+    # Set while rendering chunks: for each of the raw and the block gamut
+    # passes of _hash_html_blocks(), whether a chunk before this one has
+    # ended the search for standalone comments.
+    _comment_scans = None
+
+    # Set in a convert_parallel() worker: header ids and footnote numbers
+    # that depend on the chunks before this one are left as placeholders.
+    _deferred = None
+
+    def _defer(self, kind, value):
+        if self._deferred is None:
+            return value
+        key = self._hash_text("%s-%d" % (kind, len(self._deferred)))
+        self._deferred.append((key, kind, value))
+        return key
+
+    def _render_parallel_chunk(self, chunk, is_first, kept,
+                               comment_scans=None):
+        if "footnotes" in self.extras:
+            self.footnote_ids = []
+        self._toc = None
+        self._deferred = []
+        self._comment_scans = dict(comment_scans or ())
+        html = self._render_stream_chunk(chunk, is_first, kept)
+        # A chunk with comments is rendered again if a chunk before it
+        # turns out to have ended the search for standalone comments.
+        redo = '<!--' in chunk and chunk or None
+        return (html, getattr(self, 'footnote_ids', None), self._deferred,
+                self._toc, self._comment_scans, redo)
+
+    def _stitch_parallel_chunk(self, html, footnote_ids, deferred, toc):
+        """Fill in the placeholders in a chunk rendered by a
+        convert_parallel() worker, given the chunks before it.
+        """
+        values = {}
+        for key, kind, value in deferred:
+            if kind == "footnote-ref":
+                values[key] = str(len(self.footnote_ids) + value)
+            else:
+                values[key] = self._unique_header_id(value)
+        if footnote_ids:
+            self.footnote_ids.extend(footnote_ids)
+        if toc:
+            if self._toc is None:
+                self._toc = []
+            for level, id, name in toc:
+                self._toc.append((level, self._unhash(id, values),
+                                  self._unhash(name, values)))
+        if html is not None:
+            html = self._unhash(html, values)
+        return html
+
+    def _keep_hashes(self, text, kept):
+        """Copy the hash table entries referred to in `text` into `kept`."""
+        if 'md5-' not in text:
+            return
+        tables = (self.html_blocks, self.html_spans, self._code_table)
+        for key in _hash_text_re.findall(text):
+            for table, keep in zip(tables, kept):
+                if key in table:
+                    keep[key] = table[key]
+                    self._keep_hashes(table[key], kept)
+
+    def _restore_hashes(self, kept):
+        self.html_blocks = dict(kept[0])
+        self.html_spans = dict(kept[1])
+        self._code_table = dict(kept[2])
+
+    def _rewindable_lines(self, lines):
+        """Return a function giving a fresh iterator over `lines` for each
+        pass, and the temporary file spooled to, if one was needed.
+        """
+        if isinstance(lines, base_string_type):
+            lines = [lines]
+        try:
+            start = lines.tell()
+        except (AttributeError, IOError, OSError):
+            pass
+        else:
+            def open_lines():
+                lines.seek(start)
+                return _iter_stream_lines(lines)
+            return open_lines, None
+        if iter(lines) is not lines:
+            return lambda: _iter_stream_lines(lines), None
+
+        import tempfile
+        spool = tempfile.TemporaryFile()
+        for line in _iter_stream_lines(lines):
+            spool.write(line.encode('utf-8'))
+        def open_spool():
+            spool.seek(0)
+            return (line.decode('utf-8') for line in spool)
+        return open_spool, spool
+
+    def _survey_stream_html(self, lines):
+        """Return the index of the last line closing each block-level tag,
+        both "strict" (the closing tag alone on its line) and "liberal"
+        (the closing tag ending the line), and of the last line with a
+        '>' in it. See _hash_html_blocks() and _sorta_html_tokenize().
+        """
+        strict, liberal = {}, {}
+        last_gt = -1
+        for i, line in enumerate(lines):
+            if '>' in line:
+                last_gt = i
+            if '</' not in line:
+                continue
+            close = self._stream_html_close_re.search(line)
+            if close:
+                liberal[close.group(1)] = i
+                if close.start() == 0:
+                    strict[close.group(1)] = i
+        return strict, liberal, last_gt
+
+    def _stream_span_open(self, chunk, span_open):
+        """Return the (line, column) in `chunk` of the first '<' that
+        _sorta_html_tokenize() leaves as text but that could yet start an
+        HTML span if more text followed, or None.
+
+        `span_open` is the result for the chunk without its last line:
+        the text before it is only tokenized again once a '>' turns up.
+        """
+        line = chunk[-1]
+        if span_open is None:
+            if '<' not in line:
+                return None
+            start = (len(chunk) - 1, 0)
+        else:
+            if '>' not in line and chunk[span_open[0]][span_open[1] + 1] != '/':
+                return span_open
+            start = span_open
+        row, col = start
+        text = chunk[row][col:] + ''.join(chunk[row + 1:])
+        idx = self._sorta_html_open(text)
+        if idx == -1:
+            return None
+        idx += col
+        while idx >= len(chunk[row]):
+            idx -= len(chunk[row])
+            row += 1
+        return row, idx
+
+    def _iter_stream_chunks(self, lines, closers):
+        """Group `lines` into chunks that convert the same on their own as
+        they do as part of the whole document.
+
+        A chunk ends at a blank line unless the next line could continue
+        the block before it (indented, a quote, list item or definition),
+        or a fenced code block, HTML comment or block-level HTML tag (that
+        `closers` says is closed later on) is still open. In safe mode the
+        HTML spans are found in the whole text before it is split into
+        blocks, so a tag or auto-link left open (that a later '>' may
+        close) holds the chunk open too.
+        """
+        last_strict_close, last_liberal_close, last_gt = closers
+        chunk = []
+        started = False
+        after_blank = True
+        after_definition = False
+        after_block = False
+        in_fence = False
+        fence_hides_html = ("fenced-code-blocks" in self.extras
+                            and not self.safe_mode)
+        fence_hides = False
+        html_block_tag = None
+        in_comment = False
+        footnote_open = False
+        definition_joins = False
+        strict_tags = set()
+        liberal_tags = set()
+        span_open = None
+        for i, line in enumerate(lines):
+            if not line.strip(' \t\n'):
+                chunk.append(line)
+                after_blank = True
+                continue
+            if (after_blank and started and not in_fence and not in_comment
+                    and not footnote_open and not definition_joins
+                    and not strict_tags and not liberal_tags
+                    and not (span_open and last_gt >= i)
+                    and not self._stream_continued_line_re.match(line)):
+                yield ''.join(chunk)
+                chunk = []
+                span_open = None
+            chunk.append(line)
+            if self.safe_mode:
+                span_open = self._stream_span_open(chunk, span_open)
+            footnote_open = bool(self._stream_empty_footnote_re.match(line))
+            # Once a definition is stripped, the line after it starts a
+            # block if the definition did. So does the line after a hashed
+            # fenced code block or HTML block.
+            block_start = after_blank or after_definition or after_block
+            after_block = False
+            if not in_fence and self._stream_definition_re.match(line):
+                # Stripping a definition that follows a paragraph line
+                # joins that line to whatever comes next.
+                definition_joins = definition_joins or not after_blank
+                after_definition = block_start
+            elif line[0] not in ' \t':
+                definition_joins = False
+                after_definition = False
+            # Keep the blank lines and definitions at the very start with
+            # the first block: convert() sees that block at the start of
+            # the text.
+            started = started or not after_definition
+
+            if in_fence:
+                in_fence = not self._stream_fence_close_re.match(line)
+                if fence_hides:
+                    after_block = not in_fence
+                    after_blank = False
+                    continue
+            elif block_start and self._stream_fence_open_re.match(line):
+                in_fence = True
+                # Only a fence after a blank line is hashed ahead of the
+                # HTML; the others are found by the block gamut.
+                fence_hides = fence_hides_html and after_blank
+                if fence_hides:
+                    after_blank = False
+                    continue
+            after_blank = False
+
+            comment_start = line.rfind('<!--')
+            comment_end = line.rfind('-->')
+            if comment_start > comment_end:
+                in_comment = True
+            elif comment_end != -1:
+                in_comment = False
+
+            if '<' not in line:
+                continue
+            html_open = strict_tags or liberal_tags
+            close = self._stream_html_close_re.search(line)
+            if close:
+                tag = close.group(1)
+                liberal_tags.discard(tag)
+                if close.start() == 0:
+                    strict_tags.discard(tag)
+            open = self._stream_html_open_re.match(line)
+            if open:
+                tag = open.group(1)
+                if last_strict_close.get(tag, -1) > i:
+                    strict_tags.add(tag)
+                if (tag not in ('ins', 'del')
+                        and not (close and close.group(1) == tag)
+                        and last_liberal_close.get(tag, -1) > i):
+                    liberal_tags.add(tag)
+                if not html_open:
+                    html_block_tag = tag
+            if not strict_tags and not liberal_tags:
+                after_block = bool(
+                    close and close.group(1) == html_block_tag
+                    and (close.start() == 0
+                         or html_block_tag not in ('ins', 'del')))
+                html_block_tag = None
+        if chunk:
+            yield ''.join(chunk)
 
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
@@ -370,7 +1008,7 @@ class Markdown(object):
     #   foo: bar
     #   another-var: blah blah
     #   ---
-    _metadata_pat = re.compile("""^---[ \t]*\n((?:[ \t]*[^ \t:]+[ \t]*:[^\n]*\n)+)---[ \t]*\n""")
+    _metadata_pat = _lazy_re("""^---[ \t]*\n((?:[ \t]*[^ \t:]+[ \t]*:[^\n]*\n)+)---[ \t]*\n""")
 
     def _extract_metadata(self, text):
         # fast test
@@ -389,7 +1027,7 @@ class Markdown(object):
         return tail
 
 
-    _emacs_oneliner_vars_pat = re.compile(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
+    _emacs_oneliner_vars_pat = _lazy_re(r"-\*-\s*([^\r\n]*?)\s*-\*-", re.UNICODE)
     # This regular expression is intended to match blocks like this:
     #    PREFIX Local Variables: SUFFIX
     #    PREFIX mode: Tcl SUFFIX
@@ -398,7 +1036,7 @@ class Markdown(object):
     # - "[ \t]" is used instead of "\s" to specifically exclude newlines
     # - "(\r\n|\n|\r)" is used instead of "$" because the sre engine does
     #   not like anything other than Unix-style line terminators.
-    _emacs_local_vars_pat = re.compile(r"""^
+    _emacs_local_vars_pat = _lazy_re(r"""^
         (?P<prefix>(?:[^\r\n|\n|\r])*?)
         [\ \t]*Local\ Variables:[\ \t]*
         (?P<suffix>.*?)(?:\r\n|\n|\r)
@@ -508,7 +1146,7 @@ class Markdown(object):
 
     # Cribbed from a post by Bart Lateur:
     # <http://www.nntp.perl.org/group/perl.macperl.anyperl/154>
-    _detab_re = re.compile(r'(.*?)\t', re.M)
+    _detab_re = _lazy_re(r'(.*?)\t', re.M)
     def _detab_sub(self, match):
         g1 = match.group(1)
         return g1 + (' ' * (self.tab_width - len(g1) % self.tab_width))
@@ -538,7 +1176,7 @@ class Markdown(object):
     _block_tags_a = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math|ins|del'
     _block_tags_a += _html5tags
 
-    _strict_tag_block_re = re.compile(r"""
+    _strict_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -554,7 +1192,7 @@ class Markdown(object):
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
 
-    _liberal_tag_block_re = re.compile(r"""
+    _liberal_tag_block_re = _lazy_re(r"""
         (                       # save in \1
             ^                   # start of line  (with re.M)
             <(%s)               # start tag = \2
@@ -567,7 +1205,28 @@ class Markdown(object):
         """ % _block_tags_b,
         re.X | re.M)
 
-    _html_markdown_attr_re = re.compile(
+    # Used by _sub_tag_blocks() to find the lines that could start or end a
+    # block: a tag at the start of a line, a closing tag at the end of one.
+    _tag_block_open_re = _lazy_re(r'^<(%s)\b' % _block_tags_a, re.M)
+    _tag_block_close_re = _lazy_re(r'</(%s)>[ \t]*$' % _block_tags_a, re.M)
+    _block_tag_a_re = _lazy_re(r'(?:%s)\Z' % _block_tags_a)
+    _block_tag_b_re = _lazy_re(r'(?:%s)\Z' % _block_tags_b)
+
+    # Used by _iter_stream_chunks() to tell where a blank line can't end a
+    # chunk because a block-level construct may span it. Link and footnote
+    # definitions are stripped (with the blank lines after them) before the
+    # block gamut runs, so the blocks around one can join up: never start a
+    # chunk with one.
+    _stream_continued_line_re = _lazy_re(
+        r'[ \t>]|(?:[*+-]|\d+\.)[ \t]|\[.+\]:')
+    _stream_definition_re = _lazy_re(r'[ ]*\[.+\]:')
+    _stream_fence_open_re = _lazy_re(r'```[\w+-]*[ \t]*\n')
+    _stream_fence_close_re = _lazy_re(r'```[ \t]*\n')
+    _stream_empty_footnote_re = _lazy_re(r'[ ]{0,3}\[\^.+\]:[ \t]*\n')
+    _stream_html_open_re = _lazy_re(r'<(%s)\b' % _block_tags_a)
+    _stream_html_close_re = _lazy_re(r'</(%s)>[ \t]*\n' % _block_tags_a)
+
+    _html_markdown_attr_re = _lazy_re(
         r'''\s+markdown=("1"|'1')''')
     def _hash_html_block_sub(self, match, raw=False):
         html = match.group(1)
@@ -581,18 +1240,18 @@ class Markdown(object):
                 middle = '\n'.join(lines[1:-1])
                 last_line = lines[-1]
                 first_line = first_line[:m.start()] + first_line[m.end():]
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
-    def _hash_html_blocks(self, text, raw=False):
+    def _hash_html_blocks(self, text, raw=False, top_level=False):
         """Hashify HTML blocks
 
         We only want to do this for block-level HTML tags, such as headers,
@@ -603,6 +1262,9 @@ class Markdown(object):
 
         @param raw {boolean} indicates if these are raw HTML blocks in
             the original source. It makes a difference in "safe" mode.
+        @param top_level {boolean} indicates if `text` is the whole
+            document (or a chunk of it) rather than a list item or block
+            quote. `raw` text always is.
         """
         if '<' not in text:
             return text
@@ -621,10 +1283,9 @@ class Markdown(object):
         # the inner nested divs must be indented.
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
-        text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
-
-        # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        #
+        # Then match more liberally, simply from `\n<tag>` to `</tag>\n`.
+        text = self._sub_tag_blocks(text, hash_html_block_sub)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
@@ -632,8 +1293,17 @@ class Markdown(object):
             _hr_tag_re = _hr_tag_re_from_tab_width(self.tab_width)
             text = _hr_tag_re.sub(hash_html_block_sub, text)
 
-        # Special case for standalone HTML comments:
-        if "<!--" in text:
+        # Special case for standalone HTML comments. The first comment
+        # that isn't standalone ends the search, for the rest of the
+        # document: _comment_scans carries that over from the chunks before
+        # this one when streaming.
+        scans = None
+        if raw or top_level:
+            scans = self._comment_scans
+        if "<!--" in text and not (scans and scans.get(raw)):
+            # `text[:emitted_pos]` has already been added to `fragments`.
+            fragments = []
+            emitted_pos = 0
             start = 0
             while True:
                 # Delimiters for next comment block.
@@ -667,6 +1337,8 @@ class Markdown(object):
                     elif text[start_idx-2:start_idx] == '\n\n':
                         pass
                     else:
+                        if scans is not None:
+                            scans[raw] = True
                         break
 
                 # Validate whitespace after comment.
@@ -683,9 +1355,20 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
-                text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                placeholder = "\n\n" + key + "\n\n"
+                fragments.append(text[emitted_pos:start_idx])
+                fragments.append(placeholder)
+                emitted_pos = end_idx
+                # Markdown2 has always gone on searching from the same
+                # offset in the text with the comment replaced: that skips
+                # as much of what follows as the comment is longer than its
+                # placeholder.
+                start = end_idx + max(0, start - start_idx - len(placeholder))
+            if fragments:
+                fragments.append(text[emitted_pos:])
+                text = ''.join(fragments)
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -700,6 +1383,118 @@ class Markdown(object):
 
         return text
 
+    def _sub_tag_blocks(self, text, sub):
+        """Substitute `sub(match)` for each block found by
+        `_strict_tag_block_re` and then, in what is left, for each block
+        found by `_liberal_tag_block_re`, in a single forward scan of the
+        text.
+
+        A regex search for the end of a block that is never closed reads
+        on to the end of the document, which is quadratic in a document
+        full of such tags. Instead the lines ending in a closing tag are
+        indexed up front and each opening tag looks its block's last line
+        up with a bisect; the regexes are only run over a block known to
+        match.
+        """
+        openers = [(m.start(), m.end(), m.group(1))
+                   for m in self._tag_block_open_re.finditer(text)]
+        if not openers:
+            return text
+        liberal_closers, strict_closers = self._index_tag_block_closers(text)
+
+        # Strict blocks: (start, end, replacement).
+        strict = []
+        pos = 0
+        for start, tag_end, tag in openers:
+            if start < pos or not self._block_tag_a_re.match(tag):
+                continue
+            closers = strict_closers.get(tag)
+            if (not (closers and closers[-1] > start)
+                and not text.startswith("</%s>" % tag, tag_end)):
+                continue
+            match = self._strict_tag_block_re.match(text, start)
+            if match:
+                strict.append((start, match.end(), sub(match)))
+                pos = match.end()
+
+        if ("markdown-in-html" in self.extras
+                and any('markdown=' in text[start:end]
+                        for start, end, repl in strict)):
+            # A `markdown="1"` block leaves its contents in the text, where
+            # they can start or end a liberal block: substitute the strict
+            # blocks first, and look for liberal blocks in the result.
+            text = _splice_blocks(text, strict)
+            strict = []
+            openers = [(m.start(), m.end(), m.group(1))
+                       for m in self._tag_block_open_re.finditer(text)]
+            liberal_closers = self._index_tag_block_closers(text)[0]
+
+        # Liberal blocks, in the text with the strict blocks substituted:
+        # their lines can neither start nor end one.
+        strict_starts = [start for start, end, repl in strict]
+        def in_strict(pos):
+            i = bisect_left(strict_starts, pos + 1) - 1
+            return i >= 0 and pos < strict[i][1]
+        for tag, closers in liberal_closers.items():
+            liberal_closers[tag] = [c for c in closers if not in_strict(c)]
+
+        blocks = []
+        pos = 0
+        i_strict = 0
+        for start, tag_end, tag in openers:
+            if start < pos or not self._block_tag_b_re.match(tag):
+                continue
+            if in_strict(start):
+                continue
+            line_end = text.find('\n', start)
+            if line_end == -1:
+                line_end = len(text)
+            end = None
+            if text[tag_end:line_end].rstrip(' \t').endswith("</%s>" % tag):
+                end = line_end
+            else:
+                closers = liberal_closers.get(tag, ())
+                i = bisect_left(closers, start + 1)
+                if i < len(closers):
+                    end = text.find('\n', closers[i])
+                    if end == -1:
+                        end = len(text)
+            if end is None:
+                continue
+            # Strict blocks before this one stay as they are; those within
+            # it are substituted into its text.
+            while i_strict < len(strict) and strict[i_strict][0] < start:
+                blocks.append(strict[i_strict])
+                i_strict += 1
+            fragments = []
+            emitted_pos = start
+            while i_strict < len(strict) and strict[i_strict][0] < end:
+                s_start, s_end, s_repl = strict[i_strict]
+                fragments.append(text[emitted_pos:s_start])
+                fragments.append(s_repl)
+                emitted_pos = s_end
+                i_strict += 1
+            fragments.append(text[emitted_pos:end])
+            match = self._liberal_tag_block_re.match(''.join(fragments))
+            blocks.append((start, end, sub(match)))
+            pos = end
+        blocks.extend(strict[i_strict:])
+        return _splice_blocks(text, blocks)
+
+    def _index_tag_block_closers(self, text):
+        """Return the starts of the lines ending in `</tag>`, by tag, and
+        of those lines which are just `</tag>`.
+        """
+        liberal_closers = {}
+        strict_closers = {}
+        for m in self._tag_block_close_re.finditer(text):
+            line_start = text.rfind('\n', 0, m.start()) + 1
+            tag = m.group(1)
+            liberal_closers.setdefault(tag, []).append(line_start)
+            if m.start() == line_start:
+                strict_closers.setdefault(tag, []).append(line_start)
+        return liberal_closers, strict_closers
+
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
@@ -777,43 +1572,68 @@ class Markdown(object):
             re.X | re.M)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
-    _hr_re = re.compile(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
+    _hr_re = _lazy_re(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
+
+    # The characters that a block or span gamut stage needs to find in the
+    # text before it can change anything. The gamuts take a census of them
+    # and skip the stages whose triggers are absent, re-taking the census
+    # after every stage that ran (a few `in` scans, much cheaper than a
+    # stage's regexes).
+    _census_chars = '`\\[<>*_&~|\'".-#=+\n'
 
-    def _run_block_gamut(self, text):
+    def _census(self, text):
+        return set(ch for ch in self._census_chars if ch in text)
+
+    def _run_block_gamut(self, text, top_level=False):
         # These are all the transformations that form block-level
         # tags like paragraphs, headers, and list items.
+        census = self._census(text)
 
-        if "fenced-code-blocks" in self.extras:
+        if "fenced-code-blocks" in self.extras and '`' in census:
             text = self._do_fenced_code_blocks(text)
+            census = self._census(text)
 
-        text = self._do_headers(text)
+        if not census.isdisjoint('#=-'):
+            text = self._do_headers(text)
+            census = self._census(text)
 
         # Do Horizontal Rules:
         # On the number of spaces in horizontal rules: The spec is fuzzy: "If
         # you wish, you may use spaces between the hyphens or asterisks."
         # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
         # hr chars to one or two. We'll reproduce that limit here.
-        hr = "\n<hr"+self.empty_element_suffix+"\n"
-        text = re.sub(self._hr_re, hr, text)
+        if not census.isdisjoint('-_*'):
+            hr = "\n<hr"+self.empty_element_suffix+"\n"
+            text = self._hr_re.sub(hr, text)
+            census = self._census(text)
 
-        text = self._do_lists(text)
+        if not census.isdisjoint('*+-.'):
+            text = self._do_lists(text)
+            census = self._census(text)
 
-        if "pyshell" in self.extras:
+        if "pyshell" in self.extras and '>' in census:
             text = self._prepare_pyshell_blocks(text)
-        if "wiki-tables" in self.extras:
+            census = self._census(text)
+        if "wiki-tables" in self.extras and '|' in census:
             text = self._do_wiki_tables(text)
-        if "tables" in self.extras:
+            census = self._census(text)
+        if "tables" in self.extras and '|' in census:
             text = self._do_tables(text)
+            census = self._census(text)
 
         text = self._do_code_blocks(text)
+        census = self._census(text)
 
-        text = self._do_block_quotes(text)
+        if '>' in census:
+            text = self._do_block_quotes(text)
+            census = self._census(text)
 
         # We already ran _HashHTMLBlocks() before, in Markdown(), but that
         # was to escape raw HTML in the original Markdown source. This time,
         # we're escaping the markup we've just created, so that we don't wrap
         # <p> tags around block-level tags.
-        text = self._hash_html_blocks(text)
+        if '<' in census:
+            text = self._hash_html_blocks(text, top_level=top_level)
 
         text = self._form_paragraphs(text)
 
@@ -845,49 +1665,54 @@ class Markdown(object):
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _table_sub(self, match):
-        trim_space_re = '^[ \t\n]+|[ \t\n]+$'
-        trim_bar_re = '^\||\|$'
-
         head, underline, body = match.groups()
 
         # Determine aligns for columns.
-        cols = [cell.strip() for cell in re.sub(trim_bar_re, "", re.sub(trim_space_re, "", underline)).split('|')]
-        align_from_col_idx = {}
-        for col_idx, col in enumerate(cols):
+        aligns = []
+        for col in self._table_row_cells(underline):
             if col[0] == ':' and col[-1] == ':':
-                align_from_col_idx[col_idx] = ' align="center"'
+                aligns.append(' align="center"')
             elif col[0] == ':':
-                align_from_col_idx[col_idx] = ' align="left"'
+                aligns.append(' align="left"')
             elif col[-1] == ':':
-                align_from_col_idx[col_idx] = ' align="right"'
-
-        # thead
-        hlines = ['<table%s>' % self._html_class_str_from_tag('table'), '<thead>', '<tr>']
-        cols = [cell.strip() for cell in re.sub(trim_bar_re, "", re.sub(trim_space_re, "", head)).split('|')]
-        for col_idx, col in enumerate(cols):
-            hlines.append('  <th%s>%s</th>' % (
-                align_from_col_idx.get(col_idx, ''),
-                self._run_span_gamut(col)
-            ))
-        hlines.append('</tr>')
-        hlines.append('</thead>')
+                aligns.append(' align="right"')
+            else:
+                aligns.append('')
 
-        # tbody
+        hlines = ['<table%s>' % self._html_class_str_from_tag('table'),
+                  '<thead>']
+        hlines.extend(self._table_row_html(head, 'th', aligns))
+        hlines.append('</thead>')
         hlines.append('<tbody>')
         for line in body.strip('\n').split('\n'):
-            hlines.append('<tr>')
-            cols = [cell.strip() for cell in re.sub(trim_bar_re, "", re.sub(trim_space_re, "", line)).split('|')]
-            for col_idx, col in enumerate(cols):
-                hlines.append('  <td%s>%s</td>' % (
-                    align_from_col_idx.get(col_idx, ''),
-                    self._run_span_gamut(col)
-                ))
-            hlines.append('</tr>')
+            hlines.extend(self._table_row_html(line, 'td', aligns))
         hlines.append('</tbody>')
         hlines.append('</table>')
 
         return '\n'.join(hlines) + '\n'
 
+    def _table_row_cells(self, line):
+        """Split a table row into its cells, in one pass over the line."""
+        line = line.strip(' \t\n')
+        if line.startswith('|'):
+            line = line[1:]
+        if line.endswith('|'):
+            line = line[:-1]
+        return [cell.strip() for cell in line.split('|')]
+
+    def _table_row_html(self, line, tag, aligns):
+        """Return the lines of the HTML for a table row."""
+        row = ['<tr>']
+        for col_idx, col in enumerate(self._table_row_cells(line)):
+            row.append('  <%s%s>%s</%s>' % (
+                tag,
+                col_idx < len(aligns) and aligns[col_idx] or '',
+                col and self._run_span_gamut(col),
+                tag
+            ))
+        row.append('</tr>')
+        return row
+
     def _do_tables(self, text):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
@@ -954,33 +1779,51 @@ class Markdown(object):
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
+        census = self._census(text)
 
-        text = self._do_code_spans(text)
+        if '`' in census:
+            text = self._do_code_spans(text)
+            census = self._census(text)
 
-        text = self._escape_special_chars(text)
+        if '<' in census or '\\' in census:
+            text = self._escape_special_chars(text)
+            census = self._census(text)
 
         # Process anchor and image tags.
-        text = self._do_links(text)
+        if '[' in census:
+            text = self._do_links(text)
+            census = self._census(text)
 
         # Make links out of things like `<http://example.com/>`
         # Must come after _do_links(), because you can use < and >
         # delimiters in inline links like [this](<url>).
-        text = self._do_auto_links(text)
+        if '<' in census:
+            text = self._do_auto_links(text)
+            census = self._census(text)
 
         if "link-patterns" in self.extras:
             text = self._do_link_patterns(text)
+            census = self._census(text)
 
-        text = self._encode_amps_and_angles(text)
+        if not census.isdisjoint('&<>'):
+            text = self._encode_amps_and_angles(text)
+            census = self._census(text)
 
-        if "strike" in self.extras:
+        if "strike" in self.extras and '~' in census:
             text = self._do_strike(text)
+            census = self._census(text)
 
-        text = self._do_italics_and_bold(text)
+        if '*' in census or '_' in census:
+            text = self._do_italics_and_bold(text)
+            census = self._census(text)
 
-        if "smarty-pants" in self.extras:
+        if "smarty-pants" in self.extras and not census.isdisjoint('\'"-.'):
             text = self._do_smart_punctuation(text)
+            census = self._census(text)
 
         # Do hard breaks:
+        if '\n' not in census:
+            return text
         if "break-on-newline" in self.extras:
             text = re.sub(r" *\n", "<br%s\n" % self.empty_element_suffix, text)
         else:
@@ -989,22 +1832,90 @@ class Markdown(object):
         return text
 
     # "Sorta" because auto-links are identified as "tag" tokens.
-    _sorta_html_tokenize_re = re.compile(r"""
-        (
-            # tag
-            </?
-            (?:\w+)                                     # tag name
-            (?:\s+(?:[\w-]+:)?[\w-]+=(?:".*?"|'.*?'))*  # attributes
-            \s*/?>
-            |
-            # auto-link (e.g., <http://www.activestate.com/>)
-            <\w+[^>]*>
-            |
-            <!--.*?-->      # comment
-            |
-            <\?.*?\?>       # processing instruction
-        )
+    #
+    # Attribute values stop at their first closing quote: letting them
+    # run on to a later quote (i.e. ".*?") made unclosed tags with many
+    # attributes backtrack exponentially.
+    _sorta_html_tag_re = _lazy_re(r"""
+        </?
+        (?:\w+)                                             # tag name
+        (?:\s+(?:[\w-]+:)?[\w-]+=(?:"[^"\n]*"|'[^'\n]*'))*  # attributes
+        \s*/?>
         """, re.X)
+    _sorta_html_auto_link_start_re = _lazy_re(r"<\w")
+
+    def _sorta_html_tokenize(self, text):
+        """Split `text` into alternating text and HTML markup tokens (as
+        `re.split()` with one group would). Markup is one of:
+        - a tag
+        - an auto-link (e.g., <http://www.activestate.com/>)
+        - a one-line comment: <!-- ... -->
+        - a one-line processing instruction: <? ... ?>
+
+        The closing '>', '-->' and '?>' searches are cached, so text full
+        of unclosed '<'s is still tokenized in linear time.
+        """
+        found = {}
+        def find(sub, start):
+            if sub in found:
+                cached_start, idx = found[sub]
+                if cached_start <= start and (idx == -1 or idx >= start):
+                    return idx
+            idx = text.find(sub, start)
+            found[sub] = (start, idx)
+            return idx
+
+        tokens = []
+        pos = 0
+        start_idx = text.find('<')
+        while start_idx != -1:
+            end_idx = None
+            match = self._sorta_html_tag_re.match(text, start_idx)
+            if match:
+                end_idx = match.end()
+            elif self._sorta_html_auto_link_start_re.match(text, start_idx):
+                close_idx = find('>', start_idx + 1)
+                if close_idx != -1:
+                    end_idx = close_idx + 1
+            else:
+                for opener, closer in (('<!--', '-->'), ('<?', '?>')):
+                    if text.startswith(opener, start_idx):
+                        close_idx = find(closer, start_idx + len(opener))
+                        eol_idx = find('\n', start_idx + len(opener))
+                        if close_idx != -1 and not -1 < eol_idx < close_idx:
+                            end_idx = close_idx + len(closer)
+                        break
+            if end_idx is None:
+                start_idx = text.find('<', start_idx + 1)
+            else:
+                tokens.append(text[pos:start_idx])
+                tokens.append(text[start_idx:end_idx])
+                pos = end_idx
+                start_idx = text.find('<', end_idx)
+        tokens.append(text[pos:])
+        return tokens
+
+    # An unmatched '<' the tokenizer could still take for markup: the
+    # start of an auto-link, or a closing tag still waiting for its '>'.
+    _sorta_html_open_re = _lazy_re(r"<\w|</\w+\s*\Z")
+
+    def _sorta_html_open(self, text):
+        """Return the index of the first '<' that _sorta_html_tokenize()
+        leaves in a text token of `text`, but would take for the start of
+        markup given more text after it, or -1.
+        """
+        pos = 0
+        tokens = self._sorta_html_tokenize(text)
+        for i, token in enumerate(tokens):
+            if i % 2 == 0:
+                match = self._sorta_html_open_re.search(token)
+                if match and (match.group().startswith('</')
+                              and i != len(tokens) - 1):
+                    match = None
+                if match:
+                    return pos + match.start()
+            pos += len(token)
+        return -1
 
     def _escape_special_chars(self, text):
         # Python markdown note: the HTML tokenization here differs from
@@ -1015,7 +1926,7 @@ class Markdown(object):
         # here.
         escaped = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._sorta_html_tokenize(text):
             if is_html_markup:
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
@@ -1042,10 +1953,10 @@ class Markdown(object):
 
         tokens = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._sorta_html_tokenize(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._hash_text(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1054,9 +1965,7 @@ class Markdown(object):
         return ''.join(tokens)
 
     def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
+        return self._unhash(text, self.html_spans)
 
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
@@ -1074,7 +1983,7 @@ class Markdown(object):
             raise MarkdownError("invalid value for 'safe_mode': %r (must be "
                                 "'escape' or 'replace')" % self.safe_mode)
 
-    _inline_link_title = re.compile(r'''
+    _inline_link_title = _lazy_re(r'''
             (                   # \1
               [ \t]+
               (['"])            # quote char = \2
@@ -1083,7 +1992,7 @@ class Markdown(object):
             )?                  # title is optional
           \)$
         ''', re.X | re.S)
-    _tail_of_reference_link_re = re.compile(r'''
+    _tail_of_reference_link_re = _lazy_re(r'''
           # Match tail of: [text][id]
           [ ]?          # one optional space
           (?:\n[ ]*)?   # one optional newline followed by spaces
@@ -1092,9 +2001,9 @@ class Markdown(object):
           \]
         ''', re.X | re.S)
 
-    _whitespace = re.compile(r'\s*')
+    _whitespace = _lazy_re(r'\s*')
 
-    _strip_anglebrackets = re.compile(r'<(.*)>.*')
+    _strip_anglebrackets = _lazy_re(r'<(.*)>.*')
 
     def _find_non_whitespace(self, text, start):
         """Returns the index of the first non-whitespace character in text
@@ -1138,7 +2047,7 @@ class Markdown(object):
             url = self._strip_anglebrackets.sub(r'\1', url)
         return url, title, end_idx
 
-    def _do_links(self, text):
+    def _do_links(self, text, anchors_allowed=True):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
 
         This is a combination of Markdown.pl's _DoAnchors() and
@@ -1146,15 +2055,20 @@ class Markdown(object):
         approach. It was necessary to use a different approach than
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
+
+        The text is scanned forward once and the result is built from
+        fragments, so a document with many links stays linear. The text
+        of an anchor is itself scanned (with `anchors_allowed` false) to
+        support img links inside anchors, but not anchors inside anchors.
         """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
-        # `anchor_allowed_pos` is used to support img links inside
-        # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
+        # `text[:emitted_pos]` has already been added to `fragments`.
+        fragments = []
+        emitted_pos = 0
 
         curr_pos = 0
+        text_length = len(text)
         while True: # Handle the next link.
             # The next '[' is the start of:
             # - an inline anchor:   [text](url "title")
@@ -1171,11 +2085,9 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
+            start_idx = text.find('[', curr_pos)
+            if start_idx == -1:
                 break
-            text_length = len(text)
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
@@ -1206,8 +2118,11 @@ class Markdown(object):
                     self.footnote_ids.append(normed_id)
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
-                             % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                             % (normed_id, normed_id, self._defer(
+                                "footnote-ref", len(self.footnote_ids)))
+                    fragments.append(text[emitted_pos:start_idx])
+                    fragments.append(result)
+                    emitted_pos = curr_pos = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
@@ -1216,7 +2131,7 @@ class Markdown(object):
             # Now determine what this is by the remainder.
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
@@ -1246,18 +2161,14 @@ class Markdown(object):
                                title_str, img_class_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
-                        result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        fragments.append(text[emitted_pos:start_idx])
+                        fragments.append(result)
+                        emitted_pos = curr_pos = url_end_idx
+                    elif anchors_allowed:
+                        fragments.append(text[emitted_pos:start_idx])
+                        self._append_anchor(fragments, '<a href="%s"%s>' % (url, title_str),
+                                            link_text)
+                        emitted_pos = curr_pos = url_end_idx
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1296,20 +2207,14 @@ class Markdown(object):
                                    title_str, img_class_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
-                            result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            fragments.append(text[emitted_pos:start_idx])
+                            fragments.append(result)
+                            emitted_pos = curr_pos = match.end()
+                        elif anchors_allowed:
+                            fragments.append(text[emitted_pos:start_idx])
+                            self._append_anchor(fragments, '<a href="%s"%s>' % (url, title_str),
+                                                link_text)
+                            emitted_pos = curr_pos = match.end()
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1321,7 +2226,21 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        if not fragments:
+            return text
+        fragments.append(text[emitted_pos:])
+        return ''.join(fragments)
+
+    def _append_anchor(self, fragments, result_head, link_text):
+        """Add an <a> tag for `link_text` to `fragments`. Imgs (but not
+        anchors) in the link text are processed.
+        """
+        if "smarty-pants" in self.extras:
+            result_head = result_head.replace('"', self._escape_table['"'])
+            link_text = link_text.replace('"', self._escape_table['"'])
+        fragments.append(result_head)
+        fragments.append(self._do_links(link_text, anchors_allowed=False))
+        fragments.append('</a>')
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1341,6 +2260,9 @@ class Markdown(object):
         header_id = _slugify(text)
         if prefix and isinstance(prefix, base_string_type):
             header_id = prefix + '-' + header_id
+        return self._unique_header_id(header_id)
+
+    def _unique_header_id(self, header_id):
         if header_id in self._count_from_header_id:
             self._count_from_header_id[header_id] += 1
             header_id += '-%s' % self._count_from_header_id[header_id]
@@ -1367,8 +2289,8 @@ class Markdown(object):
         )
         '''
 
-    _h_re = re.compile(_h_re_base % '*', re.X | re.M)
-    _h_re_tag_friendly = re.compile(_h_re_base % '+', re.X | re.M)
+    _h_re = _lazy_re(_h_re_base % '*', re.X | re.M)
+    _h_re_tag_friendly = _lazy_re(_h_re_base % '+', re.X | re.M)
 
     def _h_sub(self, match):
         if match.group(1) is not None:
@@ -1385,9 +2307,13 @@ class Markdown(object):
             n = min(n + demote_headers, 6)
         header_id_attr = ""
         if "header-ids" in self.extras:
+            if self._deferred is not None:
+                # Left to _stitch_parallel_chunk() to make unique.
+                self._count_from_header_id.clear()
             header_id = self.header_id_from_text(header_group,
                 self.extras["header-ids"], n)
             if header_id:
+                header_id = self._defer("header-id", header_id)
                 header_id_attr = ' id="%s"' % header_id
         html = self._run_span_gamut(header_group)
         if "toc" in self.extras and header_id:
@@ -1430,56 +2356,39 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match, building the
+        # result from fragments in a single forward scan.
+        list_res = [_list_re_from_tab_width(self.tab_width, marker_pat,
+                                            bool(self.list_level))
+                    for marker_pat in (self._marker_ul, self._marker_ol)]
+        # The next hit for each list style. A hit at or after `pos` is
+        # still the first one from `pos` because `text` never changes.
+        next_hits = [None, None]
+        fragments = []
         pos = 0
         while True:
             # Find the *first* hit for either list style (ul or ol). We
             # match ul and ol separately to avoid adjacent lists of different
             # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
+            for i, list_re in enumerate(list_res):
+                hit = next_hits[i]
+                if hit is not False and (hit is None or hit.start() < pos):
+                    next_hits[i] = list_re.search(text, pos) or False
+            hits = [hit for hit in next_hits if hit]
             if not hits:
                 break
-            hits.sort()
-            match = hits[0][1]
+            match = min(hits, key=lambda hit: hit.start())
             start, end = match.span()
-            middle = self._list_sub(match)
-            text = text[:start] + middle + text[end:]
-            pos = start + len(middle) # start pos for next attempted match
+            fragments.append(text[pos:start])
+            fragments.append(self._list_sub(match))
+            pos = end # start pos for next attempted match
 
-        return text
+        if not fragments:
+            return text
+        fragments.append(text[pos:])
+        return ''.join(fragments)
 
-    _list_item_re = re.compile(r'''
+    _list_item_re = _lazy_re(r'''
         (\n)?                   # leading line = \1
         (^[ \t]*)               # leading whitespace = \2
         (?P<marker>%s) [ \t]+   # list marker = \3
@@ -1536,14 +2445,42 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
+        # Looking a lexer up by name imports and scans Pygments' lexer
+        # modules, so remember the answer (including "no such lexer").
+        lexer = _pygments_lexer_cache.get(lexer_name, _pygments_lexer_cache)
+        if lexer is not _pygments_lexer_cache:
+            return lexer
         try:
             from pygments import lexers, util
         except ImportError:
-            return None
+            lexer = None
+        else:
+            try:
+                lexer = lexers.get_lexer_by_name(lexer_name)
+            except util.ClassNotFound:
+                lexer = None
+        _pygments_lexer_cache[lexer_name] = lexer
+        return lexer
+
+    def _highlight_code(self, codeblock, lexer, formatter_opts):
+        """Return `codeblock` colored by _color_with_pygments(), reusing
+        the output for code seen before with the same lexer and options.
+        """
         try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+            key = (self.__class__, lexer.__class__,
+                   repr(sorted(lexer.options.items())),
+                   repr(sorted(formatter_opts.items())),
+                   md5(codeblock.encode("utf-8")).hexdigest())
+        except AttributeError:
+            # Not a Pygments lexer (a subclass supplied its own).
+            return self._color_with_pygments(codeblock, lexer,
+                                             **formatter_opts)
+        colored = _pygments_highlight_cache.get(key)
+        if colored is None:
+            colored = self._color_with_pygments(codeblock, lexer,
+                                                **formatter_opts)
+            _pygments_highlight_cache[key] = colored
+        return colored
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
         import pygments
@@ -1559,8 +2496,9 @@ class Markdown(object):
                     yield tup
                 yield 0, "</code>"
 
-            def wrap(self, source, outfile):
+            def wrap(self, source, outfile=None):
                 """Return the source with a code, pre, and div."""
+                # Pygments 2.12 dropped the `outfile` argument.
                 return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
 
         formatter_opts.setdefault("cssclass", "codehilite")
@@ -1590,22 +2528,11 @@ class Markdown(object):
                 formatter_opts = self.extras['code-color'] or {}
 
         if lexer_name:
-            def unhash_code( codeblock ):
-                for key, sanitized in list(self.html_spans.items()):
-                    codeblock = codeblock.replace(key, sanitized)
-                replacements = [
-                    ("&amp;", "&"),
-                    ("&lt;", "<"),
-                    ("&gt;", ">")
-                ]
-                for old, new in replacements:
-                    codeblock = codeblock.replace(old, new)
-                return codeblock
             lexer = self._get_pygments_lexer(lexer_name)
             if lexer:
-                codeblock = unhash_code( codeblock )
-                colored = self._color_with_pygments(codeblock, lexer,
-                                                    **formatter_opts)
+                codeblock = self._unhash_code(codeblock)
+                colored = self._highlight_code(codeblock, lexer,
+                                               formatter_opts)
                 return "\n\n%s\n\n" % colored
 
         codeblock = self._encode_code(codeblock)
@@ -1614,6 +2541,18 @@ class Markdown(object):
         return "\n\n<pre%s><code%s>%s\n</code></pre>\n\n" % (
             pre_class_str, code_class_str, codeblock)
 
+    def _unhash_code(self, codeblock):
+        """Return the source text of a code block's `codeblock`."""
+        codeblock = self._unhash_html_spans(codeblock)
+        replacements = [
+            ("&amp;", "&"),
+            ("&lt;", "<"),
+            ("&gt;", ">")
+        ]
+        for old, new in replacements:
+            codeblock = codeblock.replace(old, new)
+        return codeblock
+
     def _html_class_str_from_tag(self, tag):
         """Get the appropriate ' class="..."' string (note the leading
         space), if any, for the given tag.
@@ -1647,7 +2586,7 @@ class Markdown(object):
             re.M | re.X)
         return code_block_re.sub(self._code_block_sub, text)
 
-    _fenced_code_block_re = re.compile(r'''
+    _fenced_code_block_re = _lazy_re(r'''
         (?:\n\n|\A\n?)
         ^```([\w+-]+)?[ \t]*\n      # opening fence, $1 = optional lang
         (.*?)                       # $2 = code block content
@@ -1669,7 +2608,7 @@ class Markdown(object):
     #   space and that space will be removed in the emitted HTML
     # See `test/tm-cases/escapes.text` for a number of edge-case
     # examples.
-    _code_span_re = re.compile(r'''
+    _code_span_re = _lazy_re(r'''
             (?<!\\)
             (`+)        # \1 = Opening run of `
             (?!`)       # See Note A test/tm-cases/escapes.text
@@ -1724,34 +2663,84 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
+        hashed = self._hash_text(text)
+        self._code_table[hashed] = text
         return hashed
 
-    _strike_re = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
     def _do_strike(self, text):
-        text = self._strike_re.sub(r"<strike>\1</strike>", text)
-        return text
+        return self._sub_delimited(text, ("~~",), "strike")
 
-    _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
-    _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
-    _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
-    _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = self._sub_delimited(text, ("**",), "strong", "*_")
+            text = self._sub_delimited(text, ("*",), "em")
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = self._sub_delimited(text, ("**", "__"), "strong", "*_")
+            text = self._sub_delimited(text, ("*", "_"), "em")
         return text
 
+    def _sub_delimited(self, text, delims, tag, tail_chars=""):
+        r"""Wrap delimited runs of text (e.g. `*foo*`) in the given tag.
+
+        This gives the same result as substituting
+
+            (DELIM)(?=\S)(.+?[TAIL_CHARS]*)(?<=\S)\1    (with re.S)
+
+        for the given (same width) delimiters, but each opening delimiter
+        looks up its closer in a precomputed list rather than scanning
+        ahead for it: unmatched delimiters, e.g. in a pasted log file,
+        cost linear rather than quadratic time.
+        """
+        for delim in delims:
+            if delim in text:
+                break
+        else:
+            return text
+        width = len(delims[0])
+        opener_re = re.compile(r"(?=(?:%s)\S)"
+                               % '|'.join(re.escape(d) for d in delims))
+        closers_from_delim = {}
+        for delim in delims:
+            closers_from_delim[delim] = [m.start() for m in
+                re.finditer(r"(?<=\S)(?=%s)" % re.escape(delim), text)]
+
+        fragments = []
+        pos = 0
+        for match in opener_re.finditer(text):
+            start = match.start()
+            if start < pos:
+                continue
+            delim = text[start:start+width]
+            closers = closers_from_delim[delim]
+            i = bisect_left(closers, start + width + 1)
+            if i == len(closers):
+                continue
+            end = closers[i]
+            if tail_chars:
+                # The lazy match stops at the first closer, but the
+                # greedy tail then extends it to the *last* closer in the
+                # run of `tail_chars` that the first closer is part of.
+                run_end = end
+                while run_end < len(text) and text[run_end] in tail_chars:
+                    run_end += 1
+                for i in range(run_end - width, end, -1):
+                    if text.startswith(delim, i):
+                        end = i
+                        break
+            fragments.append(text[pos:start])
+            fragments.append("<%s>%s</%s>" % (tag, text[start+width:end], tag))
+            pos = end + width
+        if not fragments:
+            return text
+        fragments.append(text[pos:])
+        return ''.join(fragments)
+
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
     # apostrophe; e.g. ignores the fact that "round", "bout", "twer", and
     # "twixt" can be written without an initial apostrophe. This is fine because
     # using scare quotes (single quotation marks) is rare.
-    _apostrophe_year_re = re.compile(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
+    _apostrophe_year_re = _lazy_re(r"'(\d\d)(?=(\s|,|;|\.|\?|!|$))")
     _contractions = ["tis", "twas", "twer", "neath", "o", "n",
         "round", "bout", "twixt", "nuff", "fraid", "sup"]
     def _do_smart_contractions(self, text):
@@ -1763,10 +2752,10 @@ class Markdown(object):
         return text
 
     # Substitute double-quotes before single-quotes.
-    _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
-    _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
-    _closing_single_quote_re = re.compile(r"(?<=\S)'")
-    _closing_double_quote_re = re.compile(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
+    _opening_single_quote_re = _lazy_re(r"(?<!\S)'(?=\S)")
+    _opening_double_quote_re = _lazy_re(r'(?<!\S)"(?=\S)')
+    _closing_single_quote_re = _lazy_re(r"(?<=\S)'")
+    _closing_double_quote_re = _lazy_re(r'(?<=\S)"(?=(\s|,|;|\.|\?|!|$))')
     def _do_smart_punctuation(self, text):
         """Fancifies 'single quotes', "double quotes", and apostrophes.
         Converts --, ---, and ... into en dashes, em dashes, and ellipses.
@@ -1803,12 +2792,12 @@ class Markdown(object):
           )+
         )
     '''
-    _block_quote_re = re.compile(_block_quote_base % '', re.M | re.X)
-    _block_quote_re_spoiler = re.compile(_block_quote_base % '[ \t]*?!?', re.M | re.X)
-    _bq_one_level_re = re.compile('^[ \t]*>[ \t]?', re.M);
-    _bq_one_level_re_spoiler = re.compile('^[ \t]*>[ \t]*?![ \t]?', re.M);
-    _bq_all_lines_spoilers = re.compile(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
-    _html_pre_block_re = re.compile(r'(\s*<pre>.+?</pre>)', re.S)
+    _block_quote_re = _lazy_re(_block_quote_base % '', re.M | re.X)
+    _block_quote_re_spoiler = _lazy_re(_block_quote_base % '[ \t]*?!?', re.M | re.X)
+    _bq_one_level_re = _lazy_re('^[ \t]*>[ \t]?', re.M);
+    _bq_one_level_re_spoiler = _lazy_re('^[ \t]*>[ \t]*?![ \t]?', re.M);
+    _bq_all_lines_spoilers = _lazy_re(r'\A(?:^[ \t]*>[ \t]*?!.*[\n\r]*)+\Z', re.M)
+    _html_pre_block_re = _lazy_re(r'(\s*<pre>.+?</pre>)', re.S)
     def _dedent_two_spaces_sub(self, match):
         return re.sub(r'(?m)^  ', '', match.group(1))
 
@@ -1853,7 +2842,8 @@ class Markdown(object):
                 grafs.append(self.html_blocks[graf])
             else:
                 cuddled_list = None
-                if "cuddled-lists" in self.extras:
+                if ("cuddled-lists" in self.extras
+                    and not self._census(graf).isdisjoint('*+-.')):
                     # Need to put back trailing '\n' for `_list_item_re`
                     # match at the end of the paragraph.
                     li = self._list_item_re.search(graf + '\n')
@@ -1908,9 +2898,9 @@ class Markdown(object):
 
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
-    _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    _ampersand_re = _lazy_re(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
+    _naked_lt_re = _lazy_re(r'<(?![a-z/?\$!])', re.I)
+    _naked_gt_re = _lazy_re(r'''(?<![a-z0-9?!/'"-])>''', re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
@@ -1927,16 +2917,18 @@ class Markdown(object):
         return text
 
     def _encode_backslash_escapes(self, text):
-        for ch, escape in list(self._escape_table.items()):
-            text = text.replace("\\"+ch, escape)
-        return text
+        if '\\' not in text:
+            return text
+        escape_from_backslashed = self._escape_from_backslashed
+        return self._backslash_escape_re.sub(
+            lambda m: escape_from_backslashed[m.group(0)], text)
 
-    _auto_link_re = re.compile(r'<((https?|ftp):[^\'">\s]+)>', re.I)
+    _auto_link_re = _lazy_re(r'<((https?|ftp):[^\'">\s]+)>', re.I)
     def _auto_link_sub(self, match):
         g1 = match.group(1)
         return '<a href="%s">%s</a>' % (g1, g1)
 
-    _auto_email_link_re = re.compile(r"""
+    _auto_email_link_re = _lazy_re(r"""
           <
            (?:mailto:)?
           (
@@ -1968,7 +2960,12 @@ class Markdown(object):
         #
         #  Based on a filter by Matthew Wickline, posted to the BBEdit-Talk
         #  mailing list: <http://tinyurl.com/yu7ue>
-        chars = [_xml_encode_email_char_at_random(ch)
+        if "deterministic" in self.extras:
+            # The same address is always encoded the same way.
+            rand = Random(addr).random
+        else:
+            rand = random
+        chars = [_xml_encode_email_char_at_random(ch, rand)
                  for ch in "mailto:" + addr]
         # Strip the mailto: from the visible part.
         addr = '<a href="%s">%s</a>' \
@@ -1982,35 +2979,83 @@ class Markdown(object):
 
         Dev Notes: *Could* consider prefixing regexes with a negative
         lookbehind assertion to attempt to guard against this.
+
+        The patterns are tried in order, and a match overlapping one of
+        an earlier pattern is dropped; so is one that cuts into a hashed
+        placeholder. A pattern with a literal part (see
+        `_link_pattern_literal()`) isn't run at all over text without it,
+        so a long list of patterns costs little for text matching few.
         """
-        link_from_hash = {}
+        placeholders = []
+        if 'md5-' in text:
+            placeholders = [m.span() for m in _hash_text_re.finditer(text)]
+        placeholder_starts = [start for start, end in placeholders]
+        # The links made so far, as sorted (start, end, link).
+        links = []
+        link_starts = []
         for regex, repl in self.link_patterns:
-            replacements = []
+            literal = _link_pattern_literal(regex.pattern, regex.flags)
+            if literal is not None and literal not in text:
+                continue
             for match in regex.finditer(text):
+                start, end = match.span()
+                i = bisect_left(link_starts, end) - 1
+                if i >= 0 and links[i][1] > start:
+                    continue
+                if placeholders:
+                    j = bisect_left(placeholder_starts, start + 1) - 1
+                    if j >= 0 and placeholders[j][0] < start < placeholders[j][1]:
+                        continue
+                    j = bisect_left(placeholder_starts, end) - 1
+                    if j >= 0 and placeholders[j][1] > end:
+                        continue
                 if hasattr(repl, "__call__"):
                     href = repl(match)
                 else:
                     href = match.expand(repl)
-                replacements.append((match.span(), href))
-            for (start, end), href in reversed(replacements):
-                escaped_href = (
-                    href.replace('"', '&quot;')  # b/c of attr quote
-                        # To avoid markdown <em> and <strong>:
-                        .replace('*', self._escape_table['*'])
-                        .replace('_', self._escape_table['_']))
-                link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
-                link_from_hash[hash] = link
-                text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+                links.insert(i + 1, (start, end,
+                    self._link_pattern_link(href, text[start:end])))
+                link_starts.insert(i + 1, start)
+
+        if not links:
+            return text
+        fragments = []
+        pos = 0
+        for start, end, link in links:
+            fragments.append(text[pos:start])
+            fragments.append(link)
+            pos = end
+        fragments.append(text[pos:])
+        return ''.join(fragments)
+
+    def _link_pattern_link(self, href, link_text):
+        escaped_href = (
+            href.replace('"', '&quot;')  # b/c of attr quote
+                # To avoid markdown <em> and <strong>:
+                .replace('*', self._escape_table['*'])
+                .replace('_', self._escape_table['_']))
+        return '<a href="%s">%s</a>' % (escaped_href, link_text)
 
     def _unescape_special_chars(self, text):
-        # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
-        return text
+        # Swap back in all the special characters (and code runs) we've
+        # hidden.
+        return self._unhash(text, self._char_from_escape, self._code_table)
+
+    def _unhash(self, text, *tables):
+        """Swap back in the values for all `_hash_text` placeholders in
+        `text` that have an entry in one of the given key -> value
+        tables, in a single scan of the text. Placeholders without an
+        entry are left alone.
+        """
+        if 'md5-' not in text:
+            return text
+        def _unhash_sub(match):
+            key = match.group(0)
+            for table in tables:
+                if key in table:
+                    return table[key]
+            return key
+        return _hash_text_re.sub(_unhash_sub, text)
 
     def _outdent(self, text):
         # Remove one level of line-leading tabs or spaces
@@ -2034,13 +3079,130 @@ class MarkdownWithExtras(Markdown):
 
 #---- internal support functions
 
+class _StageProfile(object):
+    """Wall time, call counts and peak memory of the conversion stages of
+    a Markdown instance, for the "profile" extra.
+
+    Times include the stages called from a stage. Peak memory is the
+    most allocated (as traced by tracemalloc, Python 3.9+) during a call
+    over what was allocated at its start, and is None without it.
+    """
+    stages = (
+        "_normalize_text", "_extract_metadata", "_hash_html_blocks",
+        "_hash_html_spans", "_do_fenced_code_blocks",
+        "_strip_footnote_definitions", "_strip_link_definitions",
+        "_run_block_gamut", "_do_headers", "_do_lists", "_do_code_blocks",
+        "_do_block_quotes", "_do_tables", "_do_wiki_tables",
+        "_form_paragraphs", "_run_span_gamut", "_do_code_spans",
+        "_escape_special_chars", "_do_links", "_do_auto_links",
+        "_do_link_patterns", "_encode_amps_and_angles",
+        "_do_italics_and_bold", "_do_smart_punctuation", "_add_footnotes",
+        "_unescape_special_chars", "_unhash_html_spans",
+    )
+
+    def __init__(self, markdowner):
+        self.markdowner = markdowner
+        self.stats = {}
+        self._stack = []
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        if not hasattr(tracemalloc, "reset_peak"):
+            tracemalloc = None
+        self._tracemalloc = tracemalloc
+        self._started_tracing = False
+        self._caches = {"pygments-lexer": _pygments_lexer_cache,
+                        "pygments-highlight": _pygments_highlight_cache}
+        self._cache_counts = {}
+
+    def start(self):
+        for name in self.stages:
+            self.markdowner.__dict__.pop(name, None)
+            method = getattr(self.markdowner, name, None)
+            if method is not None:
+                setattr(self.markdowner, name, self._profiled(name, method))
+        for name, cache in self._caches.items():
+            self._cache_counts[name] = (cache.hits, cache.misses)
+        tracemalloc = self._tracemalloc
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        """Stop profiling and return {stage: (calls, seconds, peak bytes)}."""
+        for name in self.stages:
+            self.markdowner.__dict__.pop(name, None)
+        if self._started_tracing:
+            self._tracemalloc.stop()
+        return dict([(name, tuple(stat)) for name, stat in self.stats.items()])
+
+    def cache_stats(self):
+        """Return {cache: (hits, misses)} for this conversion."""
+        stats = {}
+        for name, cache in self._caches.items():
+            hits, misses = self._cache_counts[name]
+            stats[name] = (cache.hits - hits, cache.misses - misses)
+        return stats
+
+    def _profiled(self, name, method):
+        from timeit import default_timer
+        tracemalloc = self._tracemalloc
+        def profiled(*args, **kwargs):
+            # Each frame on the stack is [allocated at start, peak so far].
+            if tracemalloc:
+                current, peak = tracemalloc.get_traced_memory()
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+                tracemalloc.reset_peak()
+                self._stack.append([current, current])
+            start = default_timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = default_timer() - start
+                stat = self.stats.setdefault(name, [0, 0.0, None])
+                stat[0] += 1
+                stat[1] += elapsed
+                if tracemalloc:
+                    frame = self._stack.pop()
+                    peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                    stat[2] = max(stat[2] or 0, peak - frame[0])
+                    if self._stack:
+                        self._stack[-1][1] = max(self._stack[-1][1], peak)
+                    tracemalloc.reset_peak()
+        return profiled
+
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
     the "toc" extra is used.
     """
     metadata = None
+    profile = None
+    cache_stats = None
+    stats = None
     _toc = None
+    def profile_report(self):
+        """Return the "profile" stats as a table, slowest stage first,
+        followed by the cache hit rates.
+        """
+        if self.profile is None:
+            return None
+        lines = ["%-30s %7s %10s %10s" % ("stage", "calls", "ms", "peak KB")]
+        stats = sorted(self.profile.items(), key=lambda item: -item[1][1])
+        for name, (calls, seconds, peak) in stats:
+            lines.append("%-30s %7d %10.2f %10s" % (name, calls,
+                seconds * 1000, peak is None and "-" or "%.1f" % (peak / 1024.)))
+        for name, (hits, misses) in sorted((self.cache_stats or {}).items()):
+            if hits or misses:
+                lines.append("%-30s %7d hits %7d misses (%.0f%%)" % (
+                    name + " cache", hits, misses,
+                    100. * hits / (hits + misses)))
+        return '\n'.join(lines) + '\n'
+    profile_report = property(profile_report)
+
     def toc_html(self):
         """Return the HTML for the current TOC.
 
@@ -2076,8 +3238,8 @@ class UnicodeWithAttrs(unicode):
     toc_html = property(toc_html)
 
 ## {{{ http://code.activestate.com/recipes/577257/ (r1)
-_slugify_strip_re = re.compile(r'[^\w\s-]')
-_slugify_hyphenate_re = re.compile(r'[-\s]+')
+_slugify_strip_re = _lazy_re(r'[^\w\s-]')
+_slugify_hyphenate_re = _lazy_re(r'[-\s]+')
 def _slugify(value):
     """
     Normalizes string, converts to lowercase, removes non-alpha characters,
@@ -2130,6 +3292,88 @@ def _regex_from_encoded_pattern(s):
     else: # not an encoded regex
         return re.compile(re.escape(s))
 
+def _splice_blocks(text, blocks):
+    """Replace the (start, end, replacement) `blocks`, in order and not
+    overlapping, in `text`.
+    """
+    if not blocks:
+        return text
+    fragments = []
+    emitted_pos = 0
+    for start, end, repl in blocks:
+        fragments.append(text[emitted_pos:start])
+        fragments.append(repl)
+        emitted_pos = end
+    fragments.append(text[emitted_pos:])
+    return ''.join(fragments)
+
+def _batch_chunks(chunks, batch_size):
+    """Group numbered chunks into lists of about `batch_size` characters."""
+    batch = []
+    size = 0
+    for i, chunk in enumerate(chunks):
+        batch.append((i, chunk))
+        size += len(chunk)
+        if size >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+# Per-process state for Markdown.convert_parallel() and convert_many()
+# workers.
+_parallel_worker = None
+
+def _init_parallel_worker(md, kept):
+    global _parallel_worker
+    _parallel_worker = (md, kept)
+
+def _render_parallel_batch(batch):
+    md, kept = _parallel_worker
+    return [md._render_parallel_chunk(chunk, i == 0, kept)
+            for i, chunk in batch]
+
+def _convert_parallel_text(text):
+    # A Markdown.convert_many() document.
+    return _parallel_worker[0]._convert_with_stats(text)
+
+def _iter_stream_lines(lines):
+    """Yield each of `lines` as unicode with standardized line endings,
+    split on embedded newlines and ending with a newline.
+    """
+    for line in lines:
+        if not isinstance(line, unicode):
+            line = unicode(line, 'utf-8')
+        if '\r' in line:
+            line = re.sub("\r\n|\r", "\n", line)
+        if not line.endswith('\n'):
+            line += '\n'
+        if '\n' in line[:-1]:
+            for part in line[:-1].split('\n'):
+                yield part + '\n'
+        else:
+            yield line
+
+def _head_and_tail(lines, size=pow(2, 13)):
+    """Return the first and last `size` characters of `lines` joined,
+    enough for Markdown._get_emacs_vars().
+    """
+    head = []
+    head_len = 0
+    tail = []
+    tail_len = 0
+    for line in lines:
+        if head_len < size:
+            head.append(line)
+            head_len += len(line)
+            continue
+        tail.append(line)
+        tail_len += len(line)
+        while tail_len - len(tail[0]) >= size:
+            tail_len -= len(tail.pop(0))
+    return ''.join(head) + ''.join(tail)
+
 # Recipe: dedent (0.1.2)
 def _dedentlines(lines, tabsize=8, skip_first_line=False):
     """_dedentlines(lines, tabsize=8, skip_first_line=False) -> dedented lines
@@ -2241,6 +3485,45 @@ class _memoized(object):
       return self.func.__doc__
 
 
+class _BoundedCache(object):
+    """A cache of at most `size` items that counts its hits and misses.
+
+    When full, the least recently used item is dropped (on Pythons whose
+    dicts keep insertion order; an arbitrary one on older ones).
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._lock = threading.Lock()
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items[key] = value
+            return value
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            if len(self._items) >= self.size:
+                del self._items[next(iter(self._items))]
+            self._items[key] = value
+    def __len__(self):
+        return len(self._items)
+    def clear(self):
+        self._items.clear()
+
+# Shared by all Markdown instances: documents are often re-rendered with
+# most of their code blocks unchanged.
+_pygments_lexer_cache = _BoundedCache(64)
+_pygments_highlight_cache = _BoundedCache(512)
+
+
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
@@ -2262,6 +3545,62 @@ def _xml_oneliner_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _xml_oneliner_re_from_tab_width = _memoized(_xml_oneliner_re_from_tab_width)
 
+def _link_pattern_literal(pattern, flags):
+    """Return the longest run of literal characters that every match of
+    the given "link-patterns" regex contains, or None.
+    """
+    if flags & re.I:
+        return None
+    try:
+        try:
+            from re import _parser as sre_parse
+        except ImportError:
+            import sre_parse
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return None
+    literal = run = ''
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            run += unichr(av)
+            if len(run) > len(literal):
+                literal = run
+        else:
+            run = ''
+    return literal or None
+_link_pattern_literal = _memoized(_link_pattern_literal)
+
+def _list_re_from_tab_width(tab_width, marker_pat, sub_list):
+    """Regex for a whole ordered or unordered list (see `_do_lists`)."""
+    less_than_tab = tab_width - 1
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (less_than_tab, marker_pat, marker_pat)
+    if sub_list:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    else:
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+_list_re_from_tab_width = _memoized(_list_re_from_tab_width)
+
 def _hr_tag_re_from_tab_width(tab_width):
      return re.compile(r"""
         (?:
@@ -2298,7 +3637,7 @@ def _xml_escape_attr(attr, skip_single_quote=True):
     return escaped
 
 
-def _xml_encode_email_char_at_random(ch):
+def _xml_encode_email_char_at_random(ch, random=random):
     r = random()
     # Roughly 10% raw, 45% hex, 45% dec.
     # '@' *must* be encoded. I [John Gruber] insist.
@@ -2324,6 +3663,412 @@ def _test():
     import doctest
     doctest.testmod()
 
+# Adversarial inputs -- unclosed emphasis, strike and tags of the kind
+# found in pasted log files -- that have sent the span-level matchers
+# into catastrophic backtracking. Each builds a document from `n`
+# repetitions of a construct.
+_pathological_docs = [
+    ("unmatched-em", lambda n: "a *b x _y " * n),
+    ("unmatched-strong", lambda n: "**a __b " * n),
+    ("unmatched-strike", lambda n: "~~a " * n),
+    ("log-lines", lambda n: "12:00:01 *** WARN *ptr=0x1f __init__ failed_retry\n" * n),
+    ("unclosed-tags", lambda n: ('<span' + ' x="1"' * 10 + ' ') * n),
+    ("unclosed-attrs", lambda n: "<a b='" * n),
+    ("unclosed-comments", lambda n: "a <!-- " * n),
+    ("unclosed-pis", lambda n: "a <? " * n),
+    ("unclosed-angles", lambda n: "<x " * n),
+]
+
+def _test_pathological(n=2000, time_limit=2.0):
+    """Time the conversion of each pathological doc at `n` and `4*n`
+    repetitions. A doc fails if it takes more than `time_limit` seconds
+    or grows clearly faster than linearly.
+
+    Returns the number of failures.
+    """
+    from timeit import default_timer
+    markdowner = Markdown(extras=["strike"])
+    failures = 0
+    for name, make_doc in _pathological_docs:
+        times = []
+        for size in (n, 4 * n):
+            text = make_doc(size)
+            start = default_timer()
+            markdowner.convert(text)
+            times.append(default_timer() - start)
+        # Linear growth is 4x; allow for timer noise on fast runs.
+        growth = times[1] / max(times[0], 0.005)
+        ok = times[1] <= time_limit and growth <= 8
+        if not ok:
+            failures += 1
+        print("%-20s %8.3fs %8.3fs  x%-5.1f %s" % (
+            name, times[0], times[1], growth, ok and "ok" or "FAIL"))
+    return failures
+
+# Documents that `convert_stream()` and `convert_parallel()` have split
+# differently from how `convert()` reads them, with the extras and safe
+# mode to convert them with.
+_stream_docs = [
+    ("fence-after-link-def", ["fenced-code-blocks"], None,
+     "[r1]: http://x\n```\nfenced\n\ncode\n```\n"),
+    ("fence-after-footnote-def", ["fenced-code-blocks", "footnotes"], None,
+     "[^f1]: note\n```\nfenced\n\ncode\n```\n"),
+    ("fence-after-html-block", ["fenced-code-blocks"], None,
+     "text\n<p>p</p>\n```\n\ncode\n```\n"),
+    ("comment-after-paragraph", None, None,
+     "text\n<!-- comment -->\n\n<!-- comment -->\n"),
+    ("leading-blank-line", None, None,
+     "\n<!-- comment -->\n<div>\n</div>\n"),
+    ("leading-link-def", None, None,
+     "\n[r]: http://x\n\n<!-- a\nb -->\n[r]: http://x\n"),
+    ("unclosed-code-span", None, None,
+     "a `b\n\nc` d\n"),
+    ("comment-over-blank-line", None, "escape",
+     "<!-- a\n\nb -->\n"),
+    ("tag-over-blank-line", None, "escape",
+     "p <b\n\nc=\"d\"> e\n"),
+    ("auto-link-over-blank-lines", None, "replace",
+     "a <b\n\nc\n\n* d >\n"),
+    ("closing-tag-over-blank-line", None, "replace",
+     "a </b\n\n> c\n"),
+]
+
+def _test_stream():
+    """Check that `convert_stream()` and `convert_parallel()` give the
+    same HTML as `convert()` for each of the stream docs.
+
+    Returns the number of failures.
+    """
+    failures = 0
+    for name, extras, safe_mode, text in _stream_docs:
+        options = dict(extras=extras, safe_mode=safe_mode)
+        expected = Markdown(**options).convert(text)
+        html = "".join(Markdown(**options).convert_stream(
+            text.splitlines(True)))
+        parallel = Markdown(**options).convert_parallel(text, processes=2)
+        ok = html == expected and parallel == expected
+        if not ok:
+            failures += 1
+        print("%-28s %s" % (name, ok and "ok" or "FAIL"))
+    return failures
+
+def _test_threads(n_threads=8, rounds=4):
+    """Convert the benchmark corpora from `n_threads` threads sharing one
+    Markdown instance, and compare each result (and its TOC) to that of
+    converting the corpora one after the other.
+
+    Returns the number of mismatches.
+    """
+    import threading
+    extras = _benchmark_extras[-1][1] + ["deterministic"]
+    markdowner = Markdown(extras=extras)
+    docs = list(_benchmark_docs((), (1, 16)))
+    expected = []
+    for name, text in docs:
+        html = markdowner.convert(text)
+        expected.append((html, html.toc_html))
+    mismatches = []
+    def convert_all(offset):
+        # Each thread starts at a different doc, so that different
+        # documents are converted at the same time.
+        for i in range(rounds * len(docs)):
+            j = (i + offset) % len(docs)
+            try:
+                html = markdowner.convert(docs[j][1])
+                ok = (html, html.toc_html) == expected[j]
+            except Exception:
+                # State shared by mistake can break a conversion outright.
+                ok = False
+            if not ok:
+                mismatches.append(docs[j][0])
+    threads = [threading.Thread(target=convert_all, args=(k,))
+               for k in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for name, text in docs:
+        count = mismatches.count(name)
+        print("%-20s %s" % (name, count and "FAIL (%d)" % count or "ok"))
+    print("%d threads, %d conversions each: %d mismatches" % (
+        n_threads, rounds * len(docs), len(mismatches)))
+    return len(mismatches)
+
+# Synthetic corpora for `--benchmark`, one per kind of construct, each
+# exercising a different part of the gamut. Each makes the `i`th block
+# of a document; blocks are repeated up to the size being measured.
+_benchmark_blocks = [
+    ("prose", lambda i:
+        "Paragraph %d has *emphasis*, **strong text**, `code`, a "
+        "[link](http://example.com/%d \"Title\") and an ![image](/%d.png).\n"
+        "It wraps onto a second line with a snake_case_word, 2*3 and an "
+        "& ampersand.\n" % (i, i, i)),
+    ("lists", lambda i:
+        "* item %d\n* item with **bold** text\n    1. nested\n"
+        "    2. nested `code`\n* last one, [linked][ref%d]\n\n"
+        "[ref%d]: http://example.com/ref/%d\n" % (i, i, i, i)),
+    ("tables", lambda i:
+        "| Name | Value %d | Notes |\n|:-----|------:|:-----:|\n"
+        "| a | %d | *em* |\n| b | `x|y` | [l](/l) |\n| c | 3 | plain |\n"
+        % (i, i)),
+    ("fenced-code", lambda i:
+        "```python\ndef f%d(x):\n    # <b>not html</b> & not *em*\n"
+        "    return x * %d\n```\n\n    indented code %d\n" % (i, i, i)),
+    ("html", lambda i:
+        "<div class=\"note\">\n<p>Raw <b>HTML</b> block %d</p>\n</div>\n\n"
+        "Inline <span class=\"x\">span</span>, <a href=\"/%d\">anchor</a>, "
+        "&amp; and <br/> tags.\n" % (i, i)),
+    ("footnotes", lambda i:
+        "Claim %d needs a source[^n%d] and another[^m%d].\n\n"
+        "[^n%d]: Source %d with *emphasis*.\n\n"
+        "[^m%d]:\n    A longer note.\n\n    With a second paragraph.\n"
+        % (i, i, i, i, i, i)),
+]
+
+_benchmark_extras = [
+    ("-", None),
+    ("extras", ["fenced-code-blocks", "footnotes", "tables", "header-ids",
+                "toc", "smarty-pants", "strike", "cuddled-lists"]),
+]
+
+def _benchmark_docs(paths, sizes):
+    """Generate (name, text) for each benchmark corpus.
+
+    Synthetic corpora come at each of `sizes` KB; real-world documents
+    (`paths`, or this package's own Markdown files) as they are.
+    """
+    from os.path import join, dirname, abspath, basename, exists
+    for name, make_block in _benchmark_blocks:
+        for size in sizes:
+            blocks = []
+            length = 0
+            while length < size * 1024:
+                blocks.append(make_block(len(blocks)))
+                length += len(blocks[-1]) + 1
+            yield "%s/%dKB" % (name, size), "\n".join(blocks)
+    if not paths:
+        here = dirname(abspath(__file__))
+        paths = [p for p in (join(here, "README.md"), join(here, "example.md"))
+                 if exists(p)]
+    for path in paths:
+        fp = codecs.open(path, 'r', 'utf-8')
+        try:
+            yield basename(path), fp.read()
+        finally:
+            fp.close()
+
+def _benchmark(paths=(), sizes=(1, 16, 128), min_time=0.5,
+               baseline_path=None, save_path=None, tolerance=0.1):
+    """Time Markdown.convert() on each benchmark corpus, with and without
+    extras, printing ops/s, MB/s and peak memory (where tracemalloc is
+    available).
+
+    If `baseline_path` names the results of an earlier run (written with
+    `save_path`), each result is compared to it: more than `tolerance`
+    slower is a regression.
+
+    Returns the number of regressions.
+    """
+    import json
+    from timeit import default_timer
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    baseline = {}
+    if baseline_path:
+        fp = open(baseline_path)
+        try:
+            baseline = json.load(fp)["results"]
+        finally:
+            fp.close()
+
+    results = {}
+    regressions = 0
+    print("%-22s %-7s %9s %8s %10s %8s" % (
+        "corpus", "extras", "ops/s", "MB/s", "peak KB", "vs base"))
+    for name, text in _benchmark_docs(paths, sizes):
+        for extras_name, extras in _benchmark_extras:
+            markdowner = Markdown(extras=extras)
+            runs = 0
+            start = default_timer()
+            while True:
+                markdowner.convert(text)
+                runs += 1
+                elapsed = default_timer() - start
+                if elapsed >= min_time:
+                    break
+            ops = runs / elapsed
+            result = {"ops": ops, "mbps": ops * len(text) / 1e6}
+            if tracemalloc is not None:
+                tracemalloc.start()
+                markdowner.convert(text)
+                result["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024.
+                tracemalloc.stop()
+            key = "%s %s" % (name, extras_name)
+            results[key] = result
+
+            versus = ""
+            if key in baseline:
+                change = ops / baseline[key]["ops"] - 1
+                versus = "%+.0f%%" % (change * 100)
+                if change < -tolerance:
+                    regressions += 1
+                    versus += " SLOWER"
+            peak = result.get("peak_kb")
+            print("%-22s %-7s %9.1f %8.3f %10s %8s" % (name, extras_name,
+                ops, result["mbps"], peak is None and "-" or "%.0f" % peak,
+                versus))
+
+    if save_path:
+        fp = open(save_path, 'w')
+        try:
+            json.dump({"version": __version__,
+                       "python": sys.version.split()[0],
+                       "results": results}, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+    return regressions
+
+# A document of many short lists and links, the constructs `_do_lists`
+# and `_do_links` once rebuilt the whole document for. The `i`th block;
+# blocks are repeated up to the size being measured.
+# Corpora for `--benchmark-scaling`: a name, the head of the document and
+# a function making its `i`th block.
+_scaling_corpora = [
+    ("lists", "[r]: http://example.com/ref\n\n", lambda i:
+        "Intro para with [a link](http://example.com/%d) and [ref][r].\n\n"
+        "* item one\n* item [two](/t%d)\n\n1. first\n2. second\n\n"
+        % (i, i)),
+    ("escapes", "", lambda i:
+        "Escaped \\*not em\\* \\_not em\\_ \\`tick\\` \\[not a link\\] "
+        "\\\\ \\# \\+ \\- \\. \\! \\{ \\} \\( \\) %d, with `code \\* & <b>`, "
+        "a < b & c > d, AT&T, 4*5*6 and a_b_c.\n\n" % i),
+]
+
+def _benchmark_scaling(sizes=(10, 100, 1000, 10000), slack=2):
+    """Time Markdown.convert() on each scaling corpus at each of `sizes`
+    KB (by default 10 KB to 10 MB; the largest takes a minute or so),
+    printing the time and KB/s for each.
+
+    Linear time grows with the size: a size whose time grows more than
+    `slack` times as fast as the size over the one before is a failure.
+
+    Returns the number of failures.
+    """
+    from timeit import default_timer
+    markdowner = Markdown()
+    failures = 0
+    print("%-16s %10s %10s %8s" % ("corpus", "seconds", "KB/s", "growth"))
+    for name, head, make_block in _scaling_corpora:
+        last = last_size = None
+        for size in sizes:
+            blocks = [head]
+            length = len(head)
+            while length < size * 1024:
+                blocks.append(make_block(len(blocks)))
+                length += len(blocks[-1])
+            text = "".join(blocks)
+            del blocks
+            start = default_timer()
+            markdowner.convert(text)
+            elapsed = default_timer() - start
+            growth = ""
+            if last is not None:
+                # Allow for timer noise on fast runs.
+                ratio = elapsed / max(last, 0.005)
+                growth = "x%.1f" % ratio
+                if ratio > slack * size / float(last_size):
+                    failures += 1
+                    growth += " FAIL"
+            print("%-16s %10.3f %10.1f %8s" % ("%s/%dKB" % (name, size),
+                  elapsed, size / max(elapsed, 1e-9), growth))
+            sys.stdout.flush()
+            last, last_size = elapsed, size
+    return failures
+
+# Written to the --outdir by --changed-only: output file name -> source path
+# and hash of the source and conversion options.
+_manifest_name = ".markdown2-manifest.json"
+
+def _convert_paths(paths, encoding="utf-8", outdir=None, processes=1,
+                   changed_only=False, fingerprint="", **kwargs):
+    """Convert the Markdown files at `paths` ('-' for stdin) with
+    `Markdown.convert_many()`, yielding (path, html) for each in order.
+
+    With `outdir` the HTML is also written there, to the source's base
+    name with a ".html" extension. With `changed_only` a file is skipped
+    (and not yielded) if its source and `fingerprint` (of the conversion
+    options) are unchanged since the manifest in `outdir` was written.
+    """
+    import json
+    from os.path import basename, splitext, join, exists
+
+    manifest = {}
+    manifest_path = outdir and join(outdir, _manifest_name)
+    if outdir and not exists(outdir):
+        os.makedirs(outdir)
+    if outdir and exists(manifest_path):
+        fp = open(manifest_path)
+        try:
+            manifest = json.load(fp)
+        finally:
+            fp.close()
+
+    todo = []
+    for path in paths:
+        if path == '-':
+            data = sys.stdin.read()
+            if not isinstance(data, unicode):
+                data = data.decode(encoding)
+            out_name = None
+            digest = None
+        else:
+            fp = open(path, 'rb')
+            try:
+                data = fp.read()
+            finally:
+                fp.close()
+            out_name = splitext(basename(path))[0] + ".html"
+            digest = md5(fingerprint.encode('utf-8') + data).hexdigest()
+            data = data.decode(encoding)
+        if outdir:
+            if out_name is None:
+                raise MarkdownError("can't write stdin to an --outdir")
+            if any(out_name == t[1] for t in todo):
+                raise MarkdownError("%s: more than one input would be "
+                                    "written to %s" % (path, out_name))
+            entry = manifest.get(out_name)
+            if (changed_only and entry and entry["hash"] == digest
+                and exists(join(outdir, out_name))):
+                log.debug("%s: unchanged, skipped", path)
+                continue
+        todo.append((path, out_name, digest, data))
+
+    markdowner = Markdown(**kwargs)
+    htmls = markdowner.convert_many([t[3] for t in todo], processes)
+    for (path, out_name, digest, data), html in zip(todo, htmls):
+        if outdir:
+            fp = codecs.open(join(outdir, out_name), 'w', 'utf-8')
+            try:
+                fp.write(html)
+            finally:
+                fp.close()
+            manifest[out_name] = {"source": path, "hash": digest}
+        yield path, html
+
+    if outdir:
+        if changed_only:
+            log.info("%d of %d files unchanged, skipped",
+                     len(paths) - len(todo), len(paths))
+        fp = open(manifest_path, 'w')
+        try:
+            json.dump(manifest, fp, indent=2, sort_keys=True)
+        finally:
+            fp.close()
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -2355,17 +4100,70 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_option("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_option("-j", "--jobs", type="int", metavar="N",
+                      help="convert the PATHS in N worker processes "
+                           "(0 for one per CPU)")
+    parser.add_option("-o", "--outdir", metavar="DIR",
+                      help="write the HTML for each of the PATHS to "
+                           "DIR/BASENAME.html instead of stdout")
+    parser.add_option("--changed-only", action="store_true",
+                      help="with --outdir, skip the PATHS that are "
+                           "unchanged (as are the options) since the last "
+                           "run, per the manifest it wrote in DIR")
     parser.add_option("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
+    parser.add_option("--pathological-test", action="store_true",
+                      help="time conversion of adversarial inputs that "
+                           "can cause catastrophic regex backtracking")
+    parser.add_option("--stream-test", action="store_true",
+                      help="check that streamed and parallel conversion "
+                           "of documents that are tricky to split matches "
+                           "convert()")
+    parser.add_option("--thread-test", action="store_true",
+                      help="convert documents from several threads sharing "
+                           "one Markdown instance, and check the results "
+                           "against converting them one at a time")
+    parser.add_option("--profile", action="store_true",
+                      help="print the time, call count and peak memory of "
+                           "each conversion stage to stderr (turns on the "
+                           "'profile' extra)")
+    parser.add_option("--benchmark", action="store_true",
+                      help="time conversion of synthetic corpora and of "
+                           "the given PATHS, with and without extras")
+    parser.add_option("--benchmark-scaling", action="store_true",
+                      help="time conversion of list and link heavy and "
+                           "of escape heavy documents from 10 KB to 10 MB, "
+                           "to check that it scales linearly")
+    parser.add_option("--benchmark-baseline", metavar="FILE",
+                      help="compare --benchmark results to those saved "
+                           "in FILE; exit non-zero on a regression")
+    parser.add_option("--benchmark-save", metavar="FILE",
+                      help="save --benchmark results to FILE")
     parser.add_option("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
     parser.set_defaults(log_level=logging.INFO, compare=False,
-                        encoding="utf-8", safe_mode=None, use_file_vars=False)
+                        encoding="utf-8", safe_mode=None, use_file_vars=False,
+                        jobs=1)
     opts, paths = parser.parse_args()
     log.setLevel(opts.log_level)
+    if opts.changed_only and not opts.outdir:
+        parser.error("--changed-only requires --outdir")
+    if opts.compare and (opts.outdir or opts.jobs != 1):
+        parser.error("--compare can't be used with --jobs or --outdir")
 
     if opts.self_test:
         return _test()
+    if opts.pathological_test:
+        return _test_pathological() and 1 or 0
+    if opts.stream_test:
+        return _test_stream() and 1 or 0
+    if opts.thread_test:
+        return _test_threads() and 1 or 0
+    if opts.benchmark_scaling:
+        return _benchmark_scaling() and 1 or 0
+    if opts.benchmark:
+        return _benchmark(paths, baseline_path=opts.benchmark_baseline,
+                          save_path=opts.benchmark_save) and 1 or 0
 
     if opts.extras:
         extras = {}
@@ -2383,6 +4181,9 @@ def main(argv=None):
                 extras[ename] = earg
     else:
         extras = None
+    if opts.profile:
+        extras = extras or {}
+        extras["profile"] = None
 
     if opts.link_patterns_file:
         link_patterns = []
@@ -2408,6 +4209,41 @@ def main(argv=None):
                        "Markdown.pl")
     if not paths:
         paths = ['-']
+    if opts.outdir and '-' in paths:
+        parser.error("can't write stdin to an --outdir")
+    if opts.outdir or opts.jobs != 1:
+        if opts.link_patterns_file:
+            fp = open(opts.link_patterns_file)
+            try:
+                link_patterns_text = fp.read()
+            finally:
+                fp.close()
+        else:
+            link_patterns_text = None
+        fingerprint = repr((__version__, opts.html4tags, opts.safe_mode,
+                            sorted((extras or {}).items()),
+                            link_patterns_text, opts.use_file_vars))
+        converted = _convert_paths(paths, encoding=opts.encoding,
+            outdir=opts.outdir, processes=opts.jobs or None,
+            changed_only=opts.changed_only, fingerprint=fingerprint,
+            html4tags=opts.html4tags, safe_mode=opts.safe_mode,
+            extras=extras, link_patterns=link_patterns,
+            use_file_vars=opts.use_file_vars)
+        try:
+            for path, html in converted:
+                if not opts.outdir:
+                    if py3:
+                        sys.stdout.write(html)
+                    else:
+                        sys.stdout.write(html.encode(
+                            sys.stdout.encoding or "utf-8",
+                            'xmlcharrefreplace'))
+                if opts.profile:
+                    sys.stderr.write("%s:\n%s" % (path, html.profile_report))
+        except MarkdownError as ex:
+            # E.g. two inputs with the same base name for one --outdir.
+            parser.error(str(ex))
+        return
     for path in paths:
         if path == '-':
             text = sys.stdin.read()
@@ -2438,6 +4274,8 @@ def main(argv=None):
         else:
             sys.stdout.write(html.encode(
                 sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
+        if opts.profile:
+            sys.stderr.write(html.profile_report)
         if extras and "toc" in extras:
             log.debug("toc_html: " +
                 html.toc_html.encode(sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))